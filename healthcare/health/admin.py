@@ -1,23 +1,144 @@
+import json
+
+from django.conf import settings
 from django.contrib import admin
-from .models import Patient, Doctor, PatientDoctorMapping
+from django.core.paginator import Paginator
+from django.db import connection
+from django.utils.functional import cached_property
+from .models import Patient, Doctor, PatientDoctorMapping, Job
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    On PostgreSQL, use the planner's row estimate for the changelist count
+    and only run an exact COUNT(*) when the estimate is below
+    HEALTH_ADMIN_EXACT_COUNT_LIMIT.
+    """
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and connection.vendor == 'postgresql':
+            limit = getattr(settings, 'HEALTH_ADMIN_EXACT_COUNT_LIMIT', 100000)
+            sql, params = query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+                plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            estimate = int(plan[0]['Plan']['Plan Rows'])
+            if estimate >= limit:
+                return estimate
+        return super().count
+
+
+class InputFilter(admin.SimpleListFilter):
+    """
+    Sidebar filter rendered as a text box, so the admin never has to load
+    every related row to build a list of choices.
+    """
+    template = 'admin/health/input_filter.html'
+    lookup = None
+    numeric = False
+
+    def lookups(self, request, model_admin):
+        return ()
+
+    def has_output(self):
+        return True
+
+    def choices(self, changelist):
+        yield {
+            'value': self.value() or '',
+            'parameter_name': self.parameter_name,
+            'preserved': [
+                (key, value) for key, value in changelist.params.items()
+                if key != self.parameter_name
+            ],
+        }
+
+    def queryset(self, request, queryset):
+        value = self.value()
+        # Ignore non-numeric input for id filters rather than erroring
+        if not value or (self.numeric and not value.isdigit()):
+            return queryset
+        return queryset.filter(**{self.lookup: value})
+
+
+class OwnerFilter(InputFilter):
+    title = 'owner username'
+    parameter_name = 'owner'
+    lookup = 'created_by__username'
+
+
+class SpecialtyFilter(InputFilter):
+    title = 'specialty'
+    parameter_name = 'specialty'
+    lookup = 'specialty'
+
+
+class KindFilter(InputFilter):
+    title = 'kind'
+    parameter_name = 'kind'
+    lookup = 'kind'
+
+
+class PatientIdFilter(InputFilter):
+    title = 'patient ID'
+    parameter_name = 'patient_id'
+    lookup = 'patient_id'
+    numeric = True
+
+
+class DoctorIdFilter(InputFilter):
+    title = 'doctor ID'
+    parameter_name = 'doctor_id'
+    lookup = 'doctor_id'
+    numeric = True
+
+
+class ScalableModelAdmin(admin.ModelAdmin):
+    # Estimated page counts and no second unfiltered COUNT(*) on every page
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
 
 # Register Patient model
 @admin.register(Patient)
-class PatientAdmin(admin.ModelAdmin):
+class PatientAdmin(ScalableModelAdmin):
     list_display = ('id', 'name', 'age', 'gender', 'created_by')
-    list_filter = ('gender', 'created_by')
+    list_filter = ('gender', OwnerFilter)
+    list_select_related = ('created_by',)
+    autocomplete_fields = ('created_by',)
     search_fields = ('name',)
 
+    def get_readonly_fields(self, request, obj=None):
+        # The owner is copied onto the patient's mappings; see Patient.save
+        if obj is not None:
+            return ('created_by',)
+        return ()
+
 # Register Doctor model
 @admin.register(Doctor)
-class DoctorAdmin(admin.ModelAdmin):
+class DoctorAdmin(ScalableModelAdmin):
     list_display = ('id', 'name', 'specialty')
-    list_filter = ('specialty',)
+    list_filter = (SpecialtyFilter,)
     search_fields = ('name', 'specialty')
 
 # Register PatientDoctorMapping model
 @admin.register(PatientDoctorMapping)
-class PatientDoctorMappingAdmin(admin.ModelAdmin):
+class PatientDoctorMappingAdmin(ScalableModelAdmin):
     list_display = ('id', 'patient', 'doctor')
-    list_filter = ('doctor',)
-    search_fields = ('patient__name', 'doctor__name')
\ No newline at end of file
+    list_filter = (PatientIdFilter, DoctorIdFilter)
+    list_select_related = ('patient', 'doctor')
+    autocomplete_fields = ('patient', 'doctor')
+    search_fields = ('patient__name', 'doctor__name')
+
+# Register Job model
+@admin.register(Job)
+class JobAdmin(ScalableModelAdmin):
+    list_display = ('id', 'kind', 'status', 'progress', 'created_by', 'created_at', 'finished_at')
+    list_filter = ('status', KindFilter)
+    list_select_related = ('created_by',)
+    raw_id_fields = ('created_by',)
+    readonly_fields = ('status', 'progress', 'result', 'error', 'worker', 'started_at', 'finished_at')
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class HealthConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'health'
+
+    def ready(self):
+        # Connects the signal receivers that feed the change stream
+        from . import events  # noqa: F401
+        from . import checks  # noqa: F401
@@ -0,0 +1,17 @@
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from .revocation import revocations
+
+
+class RevocableJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication that also rejects tokens revoked through POST /api/auth/logout/."""
+
+    def get_validated_token(self, raw_token):
+        token = super().get_validated_token(raw_token)
+        jti = token.get(api_settings.JTI_CLAIM)
+        if jti is not None and revocations.is_revoked(jti):
+            raise InvalidToken(_("Token has been revoked"))
+        return token
@@ -0,0 +1,200 @@
+import asyncio
+import json
+from io import BytesIO
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import connections, transaction
+from django.http import JsonResponse
+from django.urls import Resolver404, resolve
+from rest_framework.exceptions import AuthenticationFailed
+
+from .authentication import RevocableJWTAuthentication
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+ALLOWED_METHODS = SAFE_METHODS + ('POST', 'PUT', 'PATCH', 'DELETE')
+
+
+def _error(message, status):
+    return JsonResponse({"error": message}, status=status)
+
+
+def _not_batchable():
+    return {"status": 400, "body": {"error": "This endpoint cannot be called in a batch"}}
+
+
+def _build_subrequest(request, spec, user, atomic=False):
+    # A fresh WSGI environ carrying the batch request's host and scheme, so
+    # views that build absolute URLs (e.g. pagination links) behave normally
+    method = spec.get('method', 'GET').upper()
+    path, _, query = spec['path'].partition('?')
+    body = b''
+    if spec.get('body') is not None:
+        body = json.dumps(spec['body']).encode()
+
+    environ = {
+        key: value for key, value in request.META.items()
+        if isinstance(value, str) and not key.startswith('HTTP_')
+    }
+    environ.update({
+        'HTTP_HOST': request.get_host(),
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'SCRIPT_NAME': '',
+        'QUERY_STRING': query,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': BytesIO(body),
+        'wsgi.url_scheme': request.scheme,
+    })
+    for name, value in (spec.get('headers') or {}).items():
+        environ['HTTP_' + name.upper().replace('-', '_')] = str(value)
+    if atomic:
+        # A stored idempotent response could outlive a rolled-back batch
+        environ.pop('HTTP_IDEMPOTENCY_KEY', None)
+
+    subrequest = WSGIRequest(environ)
+    # Authenticated once for the whole batch; DRF honours a forced user
+    subrequest.user = user
+    subrequest._force_auth_user = user
+    return subrequest
+
+
+def _dispatch(request, spec, user, atomic=False):
+    subrequest = _build_subrequest(request, spec, user, atomic)
+    try:
+        match = resolve(subrequest.path_info)
+    except Resolver404:
+        return {"status": 404, "body": {"error": "Not found"}}
+    subrequest.resolver_match = match
+    # Async views (the change stream) return a coroutine here, not a response
+    if asyncio.iscoroutinefunction(match.func):
+        return _not_batchable()
+
+    response = match.func(subrequest, *match.args, **match.kwargs)
+    if getattr(response, 'streaming', False):
+        response.close()
+        return _not_batchable()
+    if hasattr(response, 'render'):
+        response.render()
+
+    content = response.content.decode() if response.content else ''
+    if response.get('Content-Type', '').startswith('application/json') and content:
+        body = json.loads(content)
+    else:
+        body = content or None
+    result = {"status": response.status_code, "body": body}
+    if response.has_header('Retry-After'):
+        result['headers'] = {'Retry-After': response['Retry-After']}
+    return result
+
+
+def _dispatch_in_thread(request, spec, user):
+    # Runs on a worker thread with its own DB connection; don't leak it
+    try:
+        return _dispatch(request, spec, user)
+    finally:
+        connections.close_all()
+
+
+def _run_atomic(request, specs, user):
+    # All-or-nothing: any 4xx/5xx sub-response rolls the whole batch back
+    with transaction.atomic():
+        results = []
+        for spec in specs:
+            result = _dispatch(request, spec, user, atomic=True)
+            results.append(result)
+            if result['status'] >= 400:
+                transaction.set_rollback(True)
+                return results, False
+    return results, True
+
+
+def _validate(specs):
+    limit = getattr(settings, 'HEALTH_BATCH_MAX_REQUESTS', 20)
+    if not isinstance(specs, list) or not specs:
+        return "'requests' must be a non-empty list"
+    if len(specs) > limit:
+        return f"A batch may contain at most {limit} requests"
+    for spec in specs:
+        if not isinstance(spec, dict) or not isinstance(spec.get('path'), str):
+            return "Each request needs a 'path'"
+        if spec.get('method', 'GET').upper() not in ALLOWED_METHODS:
+            return f"Unsupported method: {spec.get('method')}"
+        if not spec['path'].startswith('/api/') or spec['path'].startswith('/api/batch/'):
+            return f"Path not allowed in a batch: {spec['path']}"
+    return None
+
+
+async def batch(request):
+    """
+    POST /api/batch/ with {"requests": [{"method", "path", "body", "headers"}],
+    "atomic": false}. Sub-requests are resolved and dispatched in-process
+    after a single authentication. Under ASGI, runs of consecutive reads
+    execute concurrently on up to HEALTH_BATCH_MAX_THREADS threads; writes
+    run in order. With "atomic": true everything runs
+    sequentially in one transaction that is rolled back if any sub-request
+    fails.
+    """
+    if request.method != 'POST':
+        return _error("Method not allowed", 405)
+    try:
+        payload = json.loads(request.body or b'{}')
+    except ValueError:
+        return _error("Invalid JSON", 400)
+    if not isinstance(payload, dict):
+        return _error("Expected a JSON object", 400)
+
+    try:
+        auth = await sync_to_async(RevocableJWTAuthentication().authenticate)(request)
+    except AuthenticationFailed as exc:
+        return JsonResponse({"detail": exc.detail}, status=401)
+    if auth is None:
+        return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+    user = auth[0]
+
+    specs = payload.get('requests')
+    problem = _validate(specs)
+    if problem:
+        return _error(problem, 400)
+
+    if payload.get('atomic'):
+        results, committed = await sync_to_async(_run_atomic)(request, specs, user)
+        return JsonResponse({"atomic": True, "committed": committed, "responses": results})
+
+    # Under WSGI the worker thread is already one of a fixed pool; don't
+    # open extra connections from it
+    concurrent = getattr(settings, 'HEALTH_BATCH_CONCURRENT_READS', True) and isinstance(request, ASGIRequest)
+    threads = asyncio.Semaphore(getattr(settings, 'HEALTH_BATCH_MAX_THREADS', 4))
+
+    async def read(spec):
+        async with threads:
+            return await sync_to_async(_dispatch_in_thread, thread_sensitive=False)(request, spec, user)
+
+    results = [None] * len(specs)
+    index = 0
+    while index < len(specs):
+        reads = []
+        while index < len(specs) and specs[index].get('method', 'GET').upper() in SAFE_METHODS:
+            reads.append(index)
+            index += 1
+        if len(reads) > 1 and concurrent:
+            responses = await asyncio.gather(*(read(specs[i]) for i in reads))
+            for i, response in zip(reads, responses):
+                results[i] = response
+        else:
+            for i in reads:
+                results[i] = await sync_to_async(_dispatch)(request, specs[i], user)
+        if index < len(specs):
+            results[index] = await sync_to_async(_dispatch)(request, specs[index], user)
+            index += 1
+
+    return JsonResponse({"atomic": False, "responses": results})
+
+
+# JWT-only endpoint. Set by hand: csrf_exempt() can't wrap async views before Django 5.0
+batch.csrf_exempt = True
+# Sub-requests repeat each other's queries by design
+batch.nplusone_exempt = True
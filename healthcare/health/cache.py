@@ -0,0 +1,101 @@
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+_MISSING = object()
+
+
+class TieredCache(BaseCache):
+    """
+    A per-process L1 cache (normally LocMemCache) in front of a shared L2
+    (Redis, Memcached). Reads are served from L1 when possible and L2 hits
+    are copied into it for at most OPTIONS['L1_TIMEOUT'] seconds, so a value
+    changed by another node can be that stale here. Writes go to both tiers;
+    add/incr/decr are decided by L2 alone. Counters, locks and anything else
+    that must agree across nodes should use the L2 alias directly.
+
+        'default': {
+            'BACKEND': 'health.cache.TieredCache',
+            'OPTIONS': {'L1': 'local', 'L2': 'shared', 'L1_TIMEOUT': 5},
+        }
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self.l1_alias = options.get('L1', 'local')
+        self.l2_alias = options.get('L2', 'shared')
+        self.l1_timeout = options.get('L1_TIMEOUT', 5)
+
+    @property
+    def l1(self):
+        return caches[self.l1_alias]
+
+    @property
+    def l2(self):
+        return caches[self.l2_alias]
+
+    def _l1_timeout(self, timeout):
+        if timeout is DEFAULT_TIMEOUT or timeout is None:
+            return self.l1_timeout
+        return min(timeout, self.l1_timeout)
+
+    def get(self, key, default=None, version=None):
+        value = self.l1.get(key, _MISSING, version=version)
+        if value is _MISSING:
+            value = self.l2.get(key, _MISSING, version=version)
+            if value is _MISSING:
+                return default
+            self.l1.set(key, value, self.l1_timeout, version=version)
+        return value
+
+    def get_many(self, keys, version=None):
+        found = self.l1.get_many(keys, version=version)
+        missing = [key for key in keys if key not in found]
+        if missing:
+            fetched = self.l2.get_many(missing, version=version)
+            if fetched:
+                self.l1.set_many(fetched, self.l1_timeout, version=version)
+            found.update(fetched)
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.l2.set(key, value, timeout, version=version)
+        self.l1.set(key, value, self._l1_timeout(timeout), version=version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self.l2.set_many(data, timeout, version=version)
+        self.l1.set_many(data, self._l1_timeout(timeout), version=version)
+        return failed
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = self.l2.add(key, value, timeout, version=version)
+        if added:
+            self.l1.set(key, value, self._l1_timeout(timeout), version=version)
+        return added
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        self.l1.delete(key, version=version)
+        return self.l2.touch(key, timeout, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        self.l1.delete(key, version=version)
+        return self.l2.incr(key, delta, version=version)
+
+    def decr(self, key, delta=1, version=None):
+        self.l1.delete(key, version=version)
+        return self.l2.decr(key, delta, version=version)
+
+    def has_key(self, key, version=None):
+        return self.get(key, _MISSING, version=version) is not _MISSING
+
+    def delete(self, key, version=None):
+        self.l1.delete(key, version=version)
+        return self.l2.delete(key, version=version)
+
+    def delete_many(self, keys, version=None):
+        self.l1.delete_many(keys, version=version)
+        self.l2.delete_many(keys, version=version)
+
+    def clear(self):
+        self.l1.clear()
+        self.l2.clear()
@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.cache.backends.redis import RedisCache
+from django.core.checks import Error, Tags, register
+from django.utils.module_loading import import_string
+
+from .cache import TieredCache
+
+
+@register(Tags.caches)
+def check_cache_backends(app_configs, **kwargs):
+    # Cache clients are imported on first use, so a missing package would
+    # otherwise only show up mid-request (and the throttle store would
+    # quietly fall back to per-process buckets)
+    errors = []
+    for alias, config in settings.CACHES.items():
+        try:
+            backend = import_string(config.get('BACKEND', ''))
+        except ImportError as exc:
+            errors.append(Error(f"Cache '{alias}' backend can't be imported: {exc}", id='health.E001'))
+            continue
+        if issubclass(backend, RedisCache):
+            try:
+                import redis  # noqa: F401
+            except ImportError:
+                errors.append(Error(
+                    f"Cache '{alias}' uses Redis but the redis package is not installed",
+                    hint="pip install -r requirements.txt", id='health.E002',
+                ))
+        if issubclass(backend, TieredCache):
+            options = config.get('OPTIONS', {})
+            for tier in ('L1', 'L2'):
+                if options.get(tier) not in settings.CACHES:
+                    errors.append(Error(
+                        f"Cache '{alias}' {tier} tier {options.get(tier)!r} is not in CACHES", id='health.E003',
+                    ))
+    return errors
@@ -0,0 +1,164 @@
+import asyncio
+import json
+import logging
+import select
+import threading
+import time
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, connections, transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .models import Patient, PatientDoctorMapping, pre_soft_delete
+from .serializers import PatientSerializer, PatientDoctorMappingSerializer
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'health_events'
+
+# Tenant-scoped models: event name prefix, owner attribute, serializer
+STREAMED_MODELS = {
+    Patient: ('patient', 'created_by_id', PatientSerializer),
+    PatientDoctorMapping: ('mapping', 'owner_id', PatientDoctorMappingSerializer),
+}
+
+# Sent instead of the backlog to a client that fell too far behind
+RESYNC = {'type': 'resync'}
+
+
+class TooManyStreams(Exception):
+    pass
+
+
+def _offer(queue, event):
+    if queue.full():
+        while not queue.empty():
+            queue.get_nowait()
+        event = RESYNC
+    queue.put_nowait(event)
+
+
+class Broker:
+    """
+    In-process fan-out of events to the asyncio queues of open streams,
+    keyed by user id. deliver() is thread-safe: it hands each event to the
+    queue's own event loop.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}  # user_id -> {queue: loop}
+        self._listener = None
+
+    def subscribe(self, user_id):
+        # Each stream pins a queue and a connection, so cap them per user
+        # (in this process)
+        limit = getattr(settings, 'HEALTH_EVENTS_MAX_STREAMS_PER_USER', 5)
+        queue = asyncio.Queue(maxsize=getattr(settings, 'HEALTH_EVENTS_QUEUE_SIZE', 100))
+        with self._lock:
+            queues = self._subscribers.setdefault(user_id, {})
+            if len(queues) >= limit:
+                raise TooManyStreams(user_id)
+            queues[queue] = asyncio.get_running_loop()
+        if use_postgres():
+            self._start_listener()
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        with self._lock:
+            queues = self._subscribers.get(user_id, {})
+            queues.pop(queue, None)
+            if not queues:
+                self._subscribers.pop(user_id, None)
+
+    def has_subscribers(self):
+        return bool(self._subscribers)
+
+    def deliver(self, user_id, event):
+        with self._lock:
+            targets = list(self._subscribers.get(user_id, {}).items())
+        for queue, loop in targets:
+            try:
+                loop.call_soon_threadsafe(_offer, queue, event)
+            except RuntimeError:
+                # The stream's loop has shut down; it unsubscribes on its way out
+                pass
+
+    def _start_listener(self):
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen_forever, name='health-events', daemon=True)
+                self._listener.start()
+
+    def _listen_forever(self):
+        while True:
+            try:
+                self._listen()
+            except Exception:
+                logger.exception("Event listener lost its database connection; reconnecting")
+                time.sleep(1)
+
+    def _listen(self):
+        # A dedicated autocommit connection, owned by this thread only
+        db = connections.create_connection('default')
+        try:
+            db.ensure_connection()
+            raw = db.connection
+            with raw.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANNEL}")
+            while True:
+                if select.select([raw], [], [], 30) == ([], [], []):
+                    continue
+                raw.poll()
+                while raw.notifies:
+                    message = json.loads(raw.notifies.pop(0).payload)
+                    self.deliver(message['user'], message['event'])
+        finally:
+            db.close()
+
+
+broker = Broker()
+
+
+def use_postgres():
+    # LISTEN/NOTIFY reaches streams in every worker; 'local' only this process
+    return (getattr(settings, 'HEALTH_EVENTS_BACKEND', 'local') == 'postgres'
+            and connection.vendor == 'postgresql')
+
+
+def publish(user_id, event):
+    """Send `event` to `user_id`'s open streams once the current transaction commits."""
+    if use_postgres():
+        # NOTIFY is queued until commit and dropped on rollback
+        payload = json.dumps({'user': user_id, 'event': event}, cls=DjangoJSONEncoder)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [CHANNEL, payload])
+    else:
+        transaction.on_commit(lambda: broker.deliver(user_id, event))
+
+
+def _listening():
+    return use_postgres() or broker.has_subscribers()
+
+
+@receiver(post_save)
+def publish_save(sender, instance, created, **kwargs):
+    if sender not in STREAMED_MODELS or not _listening():
+        return
+    prefix, owner, serializer_class = STREAMED_MODELS[sender]
+    publish(getattr(instance, owner), {
+        'type': f"{prefix}.{'created' if created else 'updated'}",
+        'id': instance.pk,
+        'data': serializer_class(instance).data,
+    })
+
+
+@receiver(pre_soft_delete)
+def publish_delete(sender, queryset, **kwargs):
+    if sender not in STREAMED_MODELS or not _listening():
+        return
+    prefix, owner, _ = STREAMED_MODELS[sender]
+    for pk, user_id in queryset.values_list('pk', owner):
+        publish(user_id, {'type': f"{prefix}.deleted", 'id': pk})
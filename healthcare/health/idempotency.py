@@ -0,0 +1,117 @@
+import hashlib
+import json
+import time
+import uuid
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.redis import RedisCache
+from rest_framework import status
+from rest_framework.response import Response
+
+IDEMPOTENCY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+
+# Delete the lock only while it still holds our token, in one round trip
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _replay(stored, fingerprint):
+    if stored['fingerprint'] != fingerprint:
+        return Response(
+            {"error": "Idempotency-Key was already used with a different request body"},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY
+        )
+    response = Response(stored['data'], status=stored['status'], headers=stored['headers'])
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _release_lock(cache, lock_key, token):
+    if isinstance(cache, RedisCache):
+        key = cache.make_and_validate_key(lock_key)
+        client = cache._cache.get_client(key, write=True)
+        client.eval(RELEASE_LOCK_SCRIPT, 1, key, cache._cache._serializer.dumps(token))
+        return
+    # Other backends have no compare-and-delete. This narrows the race to
+    # the lock expiring between the two calls, but does not close it.
+    if cache.get(lock_key) == token:
+        cache.delete(lock_key)
+
+
+def idempotent(create):
+    """
+    Honour an `Idempotency-Key` header on a viewset's `create`. The first
+    response for a key is stored (keyed by a hash of user, path and key) and
+    replayed for retries without running `create` again. Concurrent
+    duplicates wait on a short cache lock for the first request to finish.
+    """
+
+    @wraps(create)
+    def wrapped(self, request, *args, **kwargs):
+        key = request.META.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return create(self, request, *args, **kwargs)
+
+        cache = caches[_setting('HEALTH_IDEMPOTENCY_CACHE', 'default')]
+        ttl = _setting('HEALTH_IDEMPOTENCY_TTL', 24 * 60 * 60)
+        digest = hashlib.sha256(
+            f"{request.user.pk}:{request.path}:{key}".encode()
+        ).hexdigest()
+        result_key = f"idempotency:{digest}"
+        lock_key = f"idempotency-lock:{digest}"
+        fingerprint = hashlib.sha256(
+            json.dumps(request.data, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+        stored = cache.get(result_key)
+        if stored is not None:
+            return _replay(stored, fingerprint)
+
+        # A token of our own, so we never release a lock that expired and
+        # was taken by another request while we were still running
+        token = uuid.uuid4().hex
+        if not cache.add(lock_key, token, _setting('HEALTH_IDEMPOTENCY_LOCK_TIMEOUT', 30)):
+            # Another request with this key is in flight, wait for its result
+            deadline = time.monotonic() + _setting('HEALTH_IDEMPOTENCY_WAIT', 5)
+            while stored is None and time.monotonic() < deadline:
+                time.sleep(0.05)
+                stored = cache.get(result_key)
+            if stored is None:
+                return Response(
+                    {"error": "A request with this Idempotency-Key is still being processed"},
+                    status=status.HTTP_409_CONFLICT
+                )
+            return _replay(stored, fingerprint)
+
+        try:
+            # The holder may have finished between our read and taking the lock
+            stored = cache.get(result_key)
+            if stored is not None:
+                return _replay(stored, fingerprint)
+
+            response = create(self, request, *args, **kwargs)
+            # Server errors are worth retrying for real, so don't pin them
+            if response.status_code < 500:
+                cache.set(result_key, {
+                    'fingerprint': fingerprint,
+                    'status': response.status_code,
+                    'data': response.data,
+                    'headers': {
+                        name: response[name] for name in ('Location',) if response.has_header(name)
+                    },
+                }, ttl)
+        finally:
+            _release_lock(cache, lock_key, token)
+        return response
+
+    return wrapped
@@ -0,0 +1,170 @@
+import logging
+import threading
+import traceback
+from datetime import timedelta
+from io import StringIO
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Job, Patient, RevokedToken
+
+logger = logging.getLogger(__name__)
+
+# kind -> (handler, staff_only)
+registry = {}
+
+
+def register_job(kind, staff_only=False):
+    """
+    Register `handler(job)` for a job kind. The handler's return value is
+    stored as the job's JSON result; it may call `job.report_progress()`.
+    """
+    def decorator(handler):
+        registry[kind] = (handler, staff_only)
+        return handler
+    return decorator
+
+
+def enqueue(kind, payload=None, user=None):
+    if kind not in registry:
+        raise ValueError(f"Unknown job kind: {kind}")
+    return Job.objects.create(kind=kind, payload=payload or {}, created_by=user)
+
+
+def _lease_seconds():
+    return getattr(settings, 'HEALTH_JOB_LEASE', 300)
+
+
+def claim_next(worker_id):
+    """
+    Atomically move the oldest queued job to running and return it, or None.
+    Running jobs whose lease expired (their worker died) are claimed again
+    until they have been attempted HEALTH_JOB_MAX_ATTEMPTS times, then
+    failed. On PostgreSQL concurrent workers skip rows another worker has
+    locked; elsewhere a conditional UPDATE acts as compare-and-swap.
+    """
+    now = timezone.now()
+    lease_expires_at = now + timedelta(seconds=_lease_seconds())
+    Job.objects.filter(
+        status=Job.RUNNING, lease_expires_at__lt=now,
+        attempts__gte=getattr(settings, 'HEALTH_JOB_MAX_ATTEMPTS', 3),
+    ).update(status=Job.FAILED, error="Worker stopped before the job finished", finished_at=now)
+    claimable = Job.objects.filter(
+        Q(status=Job.QUEUED) | Q(status=Job.RUNNING, lease_expires_at__lt=now)
+    ).order_by('id')
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            job = claimable.select_for_update(skip_locked=True).first()
+            if job is None:
+                return None
+            job.status = Job.RUNNING
+            job.worker = worker_id
+            job.started_at = now
+            job.lease_expires_at = lease_expires_at
+            job.attempts += 1
+            job.save(update_fields=['status', 'worker', 'started_at', 'lease_expires_at', 'attempts'])
+            return job
+
+    for job_id, attempts in claimable.values_list('id', 'attempts')[:10]:
+        claimed = claimable.filter(id=job_id, attempts=attempts).update(
+            status=Job.RUNNING, worker=worker_id, started_at=now,
+            lease_expires_at=lease_expires_at, attempts=attempts + 1,
+        )
+        if claimed:
+            return Job.objects.get(id=job_id)
+    return None
+
+
+def _heartbeat(job, stop):
+    # Keep renewing the lease while the handler runs; if this process
+    # dies the lease runs out and another worker claims the job
+    try:
+        while not stop.wait(_lease_seconds() / 3):
+            Job.objects.filter(pk=job.pk, status=Job.RUNNING, attempts=job.attempts).update(
+                lease_expires_at=timezone.now() + timedelta(seconds=_lease_seconds())
+            )
+    finally:
+        connection.close()
+
+
+def run_job(job):
+    handler, _ = registry.get(job.kind, (None, False))
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(job, stop), daemon=True)
+    heartbeat.start()
+    try:
+        if handler is None:
+            raise ValueError(f"Unknown job kind: {job.kind}")
+        job.result = handler(job)
+        job.status = Job.SUCCEEDED
+        job.progress = 100
+    except Exception:
+        logger.exception("Job %s failed", job.pk)
+        job.status = Job.FAILED
+        job.error = traceback.format_exc()
+    finally:
+        stop.set()
+        heartbeat.join()
+    job.finished_at = timezone.now()
+    # Only the latest attempt may record an outcome
+    saved = Job.objects.filter(pk=job.pk, attempts=job.attempts).update(
+        result=job.result, status=job.status, progress=job.progress,
+        error=job.error, finished_at=job.finished_at,
+    )
+    if not saved:
+        logger.warning("Job %s was claimed again after its lease expired; discarding this result", job.pk)
+    return job
+
+
+# Built-in jobs
+
+@register_job('purge_deleted', staff_only=True)
+def purge_deleted(job):
+    # Imported here so workers that never run this job skip the import
+    from django.core.management import call_command
+
+    out = StringIO()
+    options = {
+        key: job.payload[key]
+        for key in ('older_than_days', 'batch_size', 'sleep', 'max_rows')
+        if key in job.payload
+    }
+    call_command('purge_deleted', stdout=out, **options)
+    return {'output': out.getvalue()}
+
+
+@register_job('purge_revoked_tokens', staff_only=True)
+def purge_revoked_tokens(job):
+    # Expired tokens are rejected anyway; their revocation rows can go
+    deleted, _ = RevokedToken.objects.filter(expires_at__lt=timezone.now()).delete()
+    return {'deleted': deleted}
+
+
+@register_job('export_patients')
+def export_patients(job):
+    # The requesting user's patients with their doctors, in id order
+    patients = (
+        Patient.objects.filter(created_by=job.created_by)
+        .order_by('id')
+        .prefetch_related('patientdoctormapping_set__doctor')
+    )
+    total = patients.count() or 1
+    rows = []
+    for index, patient in enumerate(patients.iterator(chunk_size=500), start=1):
+        rows.append({
+            'id': patient.id,
+            'name': patient.name,
+            'age': patient.age,
+            'gender': patient.gender,
+            'doctors': [
+                {'id': m.doctor.id, 'name': m.doctor.name, 'specialty': m.doctor.specialty}
+                for m in patient.patientdoctormapping_set.all()
+            ],
+        })
+        if index % 500 == 0:
+            job.report_progress(index * 100 / total)
+    return {'patients': rows}
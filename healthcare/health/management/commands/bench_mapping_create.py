@@ -0,0 +1,62 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from health.models import Patient, Doctor, PatientDoctorMapping
+from health.serializers import PatientDoctorMappingSerializer
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Compare round trips of the legacy and single-INSERT mapping create paths (rolled back)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        try:
+            with transaction.atomic():
+                user = User.objects.create_user(username='bench-mapping-create')
+                patient = Patient.objects.create(name='Bench', age=40, gender='Other', created_by=user)
+                doctors = Doctor.objects.bulk_create(
+                    Doctor(name=f'Dr. Bench {i}', specialty='Bench') for i in range(iterations * 2)
+                )
+                legacy = self.run(lambda doctor: self.legacy_create(patient, doctor, user), doctors[:iterations])
+                single = self.run(
+                    lambda doctor: PatientDoctorMapping.objects.create_for_owner(patient.id, doctor.id, user),
+                    doctors[iterations:]
+                )
+                raise Rollback
+        except Rollback:
+            pass
+
+        for label, (queries, seconds) in (('legacy', legacy), ('create_for_owner', single)):
+            self.stdout.write(
+                f"{label:>18}: {queries / iterations:.1f} queries/create, "
+                f"{seconds * 1000 / iterations:.3f} ms/create"
+            )
+
+    def run(self, create, doctors):
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            for doctor in doctors:
+                create(doctor)
+            elapsed = time.perf_counter() - start
+        # Savepoints are bookkeeping, not round trips to the tables
+        queries = [q for q in context.captured_queries if 'SAVEPOINT' not in q['sql']]
+        return len(queries), elapsed
+
+    def legacy_create(self, patient, doctor, user):
+        # The view's previous path: ownership get, exists(), serializer validation, INSERT
+        Patient.objects.get(id=patient.id, created_by=user)
+        PatientDoctorMapping.objects.filter(patient=patient.id, doctor=doctor.id).exists()
+        serializer = PatientDoctorMappingSerializer(data={'patient': patient.id, 'doctor': doctor.id})
+        serializer.is_valid(raise_exception=True)
+        serializer.save(owner=user)
@@ -0,0 +1,136 @@
+import http.client
+import multiprocessing
+import os
+import socket
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import WSGIRequestHandler, WSGIServer
+from django.core.wsgi import get_wsgi_application
+from django.db import connections
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from health.models import Patient
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(sock, port):
+    # One single-threaded server per process, all accepting on the same
+    # inherited socket: throughput can only grow by adding processes
+    server = WSGIServer(('127.0.0.1', port), QuietHandler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    server.server_name, server.server_port = '127.0.0.1', port
+    server.setup_environ()
+    server.set_app(get_wsgi_application())
+    server.serve_forever()
+
+
+def load(port, path, token, duration, results):
+    ok = errors = 0
+    headers = {'Authorization': f'Bearer {token}', 'Host': 'localhost'}
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            if response.status == 200:
+                ok += 1
+            else:
+                errors += 1
+        except OSError:
+            errors += 1
+        finally:
+            conn.close()
+    results.put((ok, errors))
+
+
+def efficiency(throughputs):
+    """{workers: req/s} -> {workers: req/s as a share of workers x the 1-worker rate}."""
+    base = throughputs[min(throughputs)] / min(throughputs)
+    return {workers: rate / (workers * base) if base else 0.0 for workers, rate in throughputs.items()}
+
+
+class Command(BaseCommand):
+    help = "Measure API throughput as worker processes are added (Unix; uses fork)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                            help="Worker process counts to measure")
+        parser.add_argument('--clients-per-worker', type=int, default=2,
+                            help="Load-generating processes per worker process")
+        parser.add_argument('--duration', type=float, default=5.0, help="Seconds per run")
+        parser.add_argument('--path', help="Path to GET (default: the benchmark user's patient)")
+        parser.add_argument('--min-efficiency', type=float, default=None,
+                            help="Fail if any run scales worse than this (0-1)")
+
+    def handle(self, *args, **options):
+        if not hasattr(os, 'fork'):
+            raise CommandError("bench_scaling needs fork(); run it on Linux or macOS")
+        cpus = os.cpu_count() or 1
+        largest = max(options['workers'])
+        if largest * (1 + options['clients_per_worker']) > cpus:
+            self.stderr.write(
+                f"Warning: {largest} workers plus their clients need more than the {cpus} CPUs here; "
+                f"the largest runs will be CPU-bound on the load generator"
+            )
+
+        user = User.objects.create_user(username=f'bench-scaling-{os.getpid()}')
+        try:
+            patient = Patient.objects.create(name='Bench', age=40, gender='Other', created_by=user)
+            token = str(RefreshToken.for_user(user).access_token)
+            path = options['path'] or f'/api/patients/{patient.id}/'
+            throughputs = {}
+            for workers in options['workers']:
+                ok, errors = self.run(workers, path, token, options)
+                throughputs[workers] = ok / options['duration']
+                self.stdout.write(f"{workers:3} workers: {throughputs[workers]:9.1f} req/s ({errors} errors)")
+        finally:
+            user.delete()
+
+        failures = []
+        self.stdout.write("\nScaling efficiency (1.0 = linear):")
+        for workers, share in efficiency(throughputs).items():
+            self.stdout.write(f"{workers:3} workers: {share:.2f}")
+            if options['min_efficiency'] is not None and share < options['min_efficiency']:
+                failures.append(str(workers))
+        if failures:
+            raise CommandError(f"Scaling below {options['min_efficiency']} at {', '.join(failures)} workers")
+
+    def run(self, workers, path, token, options):
+        context = multiprocessing.get_context('fork')
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1024)
+        port = sock.getsockname()[1]
+
+        # Children must open their own database connections
+        connections.close_all()
+        servers = [context.Process(target=serve, args=(sock, port), daemon=True) for _ in range(workers)]
+        for server in servers:
+            server.start()
+        try:
+            results = context.Queue()
+            clients = [
+                context.Process(target=load, args=(port, path, token, options['duration'], results))
+                for _ in range(workers * options['clients_per_worker'])
+            ]
+            for client in clients:
+                client.start()
+            totals = [results.get() for _ in clients]
+            for client in clients:
+                client.join()
+        finally:
+            for server in servers:
+                server.terminate()
+                server.join()
+            sock.close()
+        return sum(ok for ok, _ in totals), sum(errors for _, errors in totals)
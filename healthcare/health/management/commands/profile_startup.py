@@ -0,0 +1,98 @@
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Runs in a fresh interpreter so nothing is already imported. Prints a JSON
+# timeline on its last stdout line; -X importtime writes to stderr.
+BOOT_SCRIPT = r"""
+import json, os, sys, time
+t0 = time.perf_counter()
+marks = []
+def mark(name):
+    marks.append((name, time.perf_counter() - t0))
+
+import django
+from django.conf import settings
+settings.INSTALLED_APPS
+mark('settings loaded')
+django.setup(set_prefix=False)
+mark('apps ready')
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
+mark('wsgi application')
+if os.environ.get('PROFILE_PREWARM') == '1':
+    from health.startup import prewarm
+    prewarm()
+    mark('prewarm')
+
+from wsgiref.util import setup_testing_defaults
+environ = {'PATH_INFO': os.environ.get('PROFILE_PATH', '/api/')}
+setup_testing_defaults(environ)
+status = []
+body = application(environ, lambda s, h, exc_info=None: status.append(s))
+b''.join(body)
+mark('first request (%s)' % status[0])
+print(json.dumps(marks))
+"""
+
+
+def parse_importtime(stderr):
+    """Return [(module, self_us, cumulative_us, depth)] from -X importtime output."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+class Command(BaseCommand):
+    help = "Profile worker cold start: per-module import cost and time to first request"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=20, help="Modules to list")
+        parser.add_argument('--prewarm', action='store_true',
+                            help="Run health.startup.prewarm before the first request")
+        parser.add_argument('--path', default='/api/', help="Path for the first request")
+        parser.add_argument('--target', type=float,
+                            default=getattr(settings, 'HEALTH_STARTUP_TARGET_SECONDS', None),
+                            help="Fail if time to first request exceeds this many seconds")
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, PROFILE_PATH=options['path'],
+                   PROFILE_PREWARM='1' if options['prewarm'] else '0')
+        proc = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', BOOT_SCRIPT],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True,
+        )
+        if proc.returncode != 0:
+            raise CommandError(f"Startup failed:\n{proc.stderr[-2000:]}")
+
+        rows = parse_importtime(proc.stderr)
+        marks = json.loads(proc.stdout.strip().splitlines()[-1])
+
+        self.stdout.write(f"Slowest imports (cumulative, top {options['top']}):")
+        for name, _, cumulative, depth in sorted(rows, key=lambda r: -r[2])[:options['top']]:
+            self.stdout.write(f"  {cumulative / 1000:9.1f} ms  {name}")
+
+        packages = defaultdict(int)
+        for name, self_us, _, _ in rows:
+            packages[name.split('.')[0]] += self_us
+        self.stdout.write("\nImport time by top-level package (self):")
+        for name, self_us in sorted(packages.items(), key=lambda p: -p[1])[:options['top']]:
+            self.stdout.write(f"  {self_us / 1000:9.1f} ms  {name}")
+
+        self.stdout.write("\nTimeline:")
+        for name, seconds in marks:
+            self.stdout.write(f"  {seconds * 1000:9.1f} ms  {name}")
+
+        ready = marks[-1][1]
+        if options['target'] is not None and ready > options['target']:
+            raise CommandError(f"Time to first request {ready:.2f}s exceeds target {options['target']:.2f}s")
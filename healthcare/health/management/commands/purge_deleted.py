@@ -0,0 +1,71 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from health.models import Patient, Doctor, PatientDoctorMapping
+
+
+class Command(BaseCommand):
+    help = "Hard-delete soft-deleted health rows in small id-range batches"
+
+    # Children first, so each batch's cascade has nothing left to collect
+    models = (PatientDoctorMapping, Patient, Doctor)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=float, default=7,
+                            help="Only purge rows deleted at least this long ago")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Width of each id range deleted in one transaction")
+        parser.add_argument('--sleep', type=float, default=0.1,
+                            help="Seconds to pause between batches")
+        parser.add_argument('--max-batch-seconds', type=float, default=1.0,
+                            help="Halve the batch size whenever a batch takes longer than this")
+        parser.add_argument('--max-rows', type=int, default=None,
+                            help="Stop after purging this many rows in total")
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['older_than_days'])
+        remaining = options['max_rows']
+
+        for model in self.models:
+            if remaining is not None and remaining <= 0:
+                break
+            purged = self.purge(model, cutoff, remaining, options)
+            if remaining is not None:
+                remaining -= purged
+            self.stdout.write(f"{model._meta.label}: purged {purged} rows")
+
+    def purge(self, model, cutoff, limit, options):
+        dead = model.all_objects.filter(deleted_at__lt=cutoff)
+        if options['dry_run']:
+            return dead.count()
+
+        batch_size = options['batch_size']
+        purged = 0
+        low = 0
+        while limit is None or purged < limit:
+            # Jump over live rows, so sparse dead ids cost no empty batches
+            low = dead.filter(id__gte=low).order_by('id').values_list('id', flat=True).first()
+            if low is None:
+                break
+            started = time.monotonic()
+            with transaction.atomic():
+                batch = dead.filter(id__gte=low, id__lt=low + batch_size)
+                if limit is not None:
+                    batch = model.all_objects.filter(
+                        id__in=list(batch.order_by('id').values_list('id', flat=True)[:limit - purged])
+                    )
+                count, _ = batch.hard_delete()
+            purged += count
+            low += batch_size
+
+            # Back off when batches get slow, i.e. we're contending for locks
+            if time.monotonic() - started > options['max_batch_seconds'] and batch_size > 1:
+                batch_size //= 2
+            if count and options['sleep']:
+                time.sleep(options['sleep'])
+        return purged
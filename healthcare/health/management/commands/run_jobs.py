@@ -0,0 +1,83 @@
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+
+from health.jobs import claim_next, run_job
+
+
+def process_main(options):
+    # Entry point for child processes; under the spawn start method (Windows,
+    # macOS) the child starts from a bare interpreter
+    django.setup()
+    Command().run_process(options)
+
+
+class Command(BaseCommand):
+    help = "Run queued background jobs with a pool of worker threads and/or processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=4,
+                            help="Worker threads per process")
+        parser.add_argument('--processes', type=int, default=1,
+                            help="Worker processes, each running --threads threads")
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help="Seconds an idle worker waits before polling again")
+        parser.add_argument('--burst', action='store_true',
+                            help="Exit once the queue is empty instead of polling forever")
+
+    def handle(self, *args, **options):
+        if options['processes'] > 1:
+            # Children must open their own database connections
+            connections.close_all()
+            workers = [
+                multiprocessing.Process(target=process_main, args=(options,))
+                for _ in range(options['processes'])
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        else:
+            self.run_process(options)
+
+    def run_process(self, options):
+        self.stop = threading.Event()
+        if options['threads'] == 1:
+            # Run inline so burst mode shares the caller's connection (tests)
+            self.work(0, options)
+            return
+
+        threads = [
+            threading.Thread(target=self.work, args=(index, options), daemon=True)
+            for index in range(options['threads'])
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        except KeyboardInterrupt:
+            self.stop.set()
+
+    def work(self, index, options):
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:{index}"
+        try:
+            while not self.stop.is_set():
+                close_old_connections()
+                job = claim_next(worker_id)
+                if job is None:
+                    if options['burst']:
+                        return
+                    time.sleep(options['poll_interval'])
+                    continue
+                run_job(job)
+                self.stdout.write(f"{worker_id} finished {job}")
+        finally:
+            if options['threads'] > 1:
+                connections.close_all()
@@ -0,0 +1,73 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from health.partitioning import (
+    TENANT_TABLES, is_partitioned, partitions, pruning_report, split_partition,
+)
+
+
+class Command(BaseCommand):
+    help = "Inspect, split and verify pruning of the owner hash partitions (PostgreSQL)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['status', 'split', 'explain'],
+                            help="split locks the whole table (and, for patients, the mappings "
+                                 "table) against reads and writes while it runs; "
+                                 "use a maintenance window")
+        parser.add_argument('--table', choices=list(TENANT_TABLES),
+                            help="Table to split (default: both)")
+        parser.add_argument('--partition',
+                            help="Partition to split (default: the one with the most rows)")
+        parser.add_argument('--lock-timeout', default='5s',
+                            help="Give up a split rather than wait this long for the table lock")
+        parser.add_argument('--user', type=int,
+                            help="User id whose queries to EXPLAIN (default: the first owner)")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("Tenant partitioning is only available on PostgreSQL")
+        with connection.cursor() as cursor:
+            missing = [table for table in TENANT_TABLES if not is_partitioned(cursor, table)]
+        if missing:
+            raise CommandError(f"Not partitioned (run migrate): {', '.join(missing)}")
+        getattr(self, options['action'])(options)
+
+    def status(self, options):
+        with connection.cursor() as cursor:
+            for table in TENANT_TABLES:
+                self.stdout.write(f"{table}:")
+                for name, modulus, remainder, rows in partitions(cursor, table):
+                    self.stdout.write(f"  {name:45} modulus {modulus:3} remainder {remainder:3} ~{rows} rows")
+
+    def split(self, options):
+        if options['partition'] and not options['table']:
+            raise CommandError("--partition needs --table")
+        tables = [options['table']] if options['table'] else list(TENANT_TABLES)
+        for table in tables:
+            # Each split is its own transaction, so the tables are locked one at a time
+            with transaction.atomic(), connection.cursor() as cursor:
+                name = options['partition']
+                if name is None:
+                    name = max(partitions(cursor, table), key=lambda row: row[3])[0]
+                try:
+                    created = split_partition(cursor, table, name, options['lock_timeout'])
+                except ValueError as exc:
+                    raise CommandError(str(exc))
+            self.stdout.write(f"{table}: split {name} into {', '.join(created)}")
+
+    def explain(self, options):
+        if options['user'] is not None:
+            user = User.objects.filter(pk=options['user']).first()
+        else:
+            user = User.objects.filter(patient__isnull=False).order_by('pk').first()
+        if user is None:
+            raise CommandError("No user to explain queries for")
+
+        failures = []
+        for label, scanned in pruning_report(user).items():
+            self.stdout.write(f"{label:22} {', '.join(scanned) or '-'}")
+            if len(scanned) > 1:
+                failures.append(label)
+        if failures:
+            raise CommandError(f"Queries not pruned to one partition: {', '.join(failures)}")
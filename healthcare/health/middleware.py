@@ -0,0 +1,183 @@
+import logging
+import traceback
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.messages.middleware import MessageMiddleware
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.middleware.csrf import CsrfViewMiddleware
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+from django.utils.regex_helper import _lazy_re_compile
+
+from .querybudget import QueryRecorder
+
+try:
+    import brotli
+except ImportError:  # optional: pip install brotli
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+re_accepts_br = _lazy_re_compile(r"\bbr\b")
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/')
+# Compressing these would buffer events that must reach the client immediately
+UNCOMPRESSIBLE_TYPES = ('text/event-stream',)
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """
+    GZipMiddleware that also negotiates brotli (when the `brotli` package is
+    installed), only touches JSON/text bodies and skips responses smaller
+    than HEALTH_COMPRESSION_MIN_SIZE. Streaming responses are compressed
+    chunk by chunk.
+    """
+
+    def process_response(self, request, response):
+        content_type = response.get('Content-Type', '')
+        if (not content_type.startswith(COMPRESSIBLE_TYPES)
+                or content_type.startswith(UNCOMPRESSIBLE_TYPES)):
+            return response
+        min_size = getattr(settings, 'HEALTH_COMPRESSION_MIN_SIZE', 1024)
+        if not response.streaming and len(response.content) < min_size:
+            return response
+
+        accept = request.META.get('HTTP_ACCEPT_ENCODING', '')
+        if brotli is None or not re_accepts_br.search(accept) or response.has_header('Content-Encoding'):
+            return super().process_response(request, response)
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        quality = getattr(settings, 'HEALTH_BROTLI_QUALITY', 5)
+        if response.streaming:
+            original = response.streaming_content
+            if response.is_async:
+                async def brotli_wrapper():
+                    compressor = brotli.Compressor(quality=quality)
+                    async for chunk in original:
+                        yield compressor.process(chunk) + compressor.flush()
+                    yield compressor.finish()
+            else:
+                def brotli_wrapper():
+                    compressor = brotli.Compressor(quality=quality)
+                    for chunk in original:
+                        yield compressor.process(chunk) + compressor.flush()
+                    yield compressor.finish()
+            response.streaming_content = brotli_wrapper()
+            del response.headers['Content-Length']
+        else:
+            compressed = brotli.compress(response.content, quality=quality)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response.headers['Content-Length'] = str(len(response.content))
+
+        # Strong ETags no longer match the encoded body
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Encoding'] = 'br'
+        return response
+
+
+class NPlusOneMiddleware:
+    """
+    Development aid: logs a warning with the call-site stack when a single
+    request runs the same SQL shape HEALTH_NPLUSONE_THRESHOLD or more times.
+    Enabled by HEALTH_NPLUSONE_DETECTION; views that legitimately repeat
+    queries (e.g. the batch endpoint) set `nplusone_exempt = True`. Runs
+    natively in async chains, so async views (the change stream) are not
+    pushed onto a thread.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'HEALTH_NPLUSONE_DETECTION', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.threshold = getattr(settings, 'HEALTH_NPLUSONE_THRESHOLD', 5)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        recorder = QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            response = self.get_response(request)
+        self.report(request, recorder)
+        return response
+
+    async def __acall__(self, request):
+        # Connections are per thread: the request's ORM calls run on its
+        # thread-sensitive executor thread, so the recorder is installed there
+        recorder = QueryRecorder()
+        await sync_to_async(_add_execute_wrapper)(recorder)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(_remove_execute_wrapper)(recorder)
+        self.report(request, recorder)
+        return response
+
+    def report(self, request, recorder):
+        if not getattr(request, '_nplusone_exempt', False):
+            for shape, count, site in recorder.repeated(self.threshold):
+                logger.warning(
+                    "Possible N+1 on %s %s: %d x %s\n%s", request.method, request.path,
+                    count, shape, ''.join(traceback.format_list(site)).rstrip()
+                )
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._nplusone_exempt = getattr(view_func, 'nplusone_exempt', False)
+
+
+def _add_execute_wrapper(wrapper):
+    connection.execute_wrappers.append(wrapper)
+
+
+def _remove_execute_wrapper(wrapper):
+    connection.execute_wrappers.remove(wrapper)
+
+
+def is_api_request(request):
+    return request.path_info.startswith(getattr(settings, 'HEALTH_API_PREFIX', '/api/'))
+
+
+class SiteOnlyMiddlewareMixin:
+    """
+    Skip the wrapped middleware for API requests, which authenticate with
+    JWTs and never use sessions, CSRF tokens or messages. The admin and
+    other site pages still get it.
+    """
+
+    def __call__(self, request):
+        if is_api_request(request):
+            # A coroutine when the chain is async; the caller awaits it
+            return self.get_response(request)
+        return super().__call__(request)
+
+
+class SiteSessionMiddleware(SiteOnlyMiddlewareMixin, SessionMiddleware):
+    pass
+
+
+class SiteAuthenticationMiddleware(SiteOnlyMiddlewareMixin, AuthenticationMiddleware):
+    pass
+
+
+class SiteMessageMiddleware(SiteOnlyMiddlewareMixin, MessageMiddleware):
+    pass
+
+
+class SiteCsrfViewMiddleware(SiteOnlyMiddlewareMixin, CsrfViewMiddleware):
+    def process_view(self, request, callback, callback_args, callback_kwargs):
+        # Called by the handler directly, outside __call__
+        if is_api_request(request):
+            return None
+        return super().process_view(request, callback, callback_args, callback_kwargs)
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.30 on 2026-10-19 05:16
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_patient_owner(apps, schema_editor):
+    Patient = apps.get_model('health', 'Patient')
+    PatientDoctorMapping = apps.get_model('health', 'PatientDoctorMapping')
+    PatientDoctorMapping.objects.update(owner_id=models.Subquery(
+        Patient.objects.filter(pk=models.OuterRef('patient_id')).values('created_by_id')[:1]
+    ))
+    if schema_editor.connection.vendor == 'postgresql':
+        # Fire the deferred FK checks now; ALTER TABLE refuses to run with
+        # trigger events pending
+        schema_editor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('health', '0003_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patientdoctormapping',
+            name='owner',
+            field=models.ForeignKey(db_index=False, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(copy_patient_owner, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='patientdoctormapping',
+            name='owner',
+            field=models.ForeignKey(db_index=False, editable=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterUniqueTogether(
+            name='patientdoctormapping',
+            unique_together={('owner', 'patient', 'doctor')},
+        ),
+    ]
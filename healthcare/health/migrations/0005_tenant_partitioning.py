@@ -0,0 +1,107 @@
+from django.conf import settings
+from django.db import migrations
+
+# The SQL is frozen here rather than imported from health.partitioning, so
+# later changes to that module can't change what this migration does.
+# Patients come first: mappings reference them.
+TENANT_TABLES = {
+    'health_patient': 'created_by_id',
+    'health_patientdoctormapping': 'owner_id',
+}
+
+
+def partition_table(schema_editor, cursor, table, key, count):
+    # Rebuild `table` as `count` hash partitions on `key`, keeping its rows,
+    # indexes and unique/foreign key constraints. The primary key becomes
+    # (key, id); foreign keys pointing at the table must be dropped first.
+    qn = schema_editor.quote_name
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = %s::regclass AND contype IN ('u', 'f') ORDER BY contype DESC",
+        [table]
+    )
+    constraints = cursor.fetchall()
+    cursor.execute(
+        "SELECT indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s "
+        "AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass)",
+        [table, table]
+    )
+    indexes = [row[0] for row in cursor.fetchall()]
+    cursor.execute(
+        "SELECT attname FROM pg_attribute WHERE attrelid = %s::regclass "
+        "AND attnum > 0 AND NOT attisdropped ORDER BY attnum", [table]
+    )
+    columns = ', '.join(qn(row[0]) for row in cursor.fetchall())
+
+    # A plain sequence: identity columns on partitioned tables need PostgreSQL 17
+    new_table = f"{table}_partitioned"
+    sequence = f"{table}_tenant_id_seq"
+    cursor.execute(f"LOCK TABLE {qn(table)} IN EXCLUSIVE MODE")
+    cursor.execute(f"CREATE SEQUENCE {qn(sequence)}")
+    cursor.execute(
+        f"SELECT setval(%s, COALESCE((SELECT MAX(id) FROM {qn(table)}), 0) + 1, false)", [sequence]
+    )
+    cursor.execute(f"CREATE TABLE {qn(new_table)} (LIKE {qn(table)}) PARTITION BY HASH ({qn(key)})")
+    cursor.execute(f"ALTER TABLE {qn(new_table)} ALTER COLUMN id SET DEFAULT nextval('{sequence}')")
+    cursor.execute(
+        f"ALTER TABLE {qn(new_table)} ADD CONSTRAINT {qn(table + '_pkey_tenant')} PRIMARY KEY ({qn(key)}, id)"
+    )
+    for remainder in range(count):
+        cursor.execute(
+            f"CREATE TABLE {qn(f'{table}_m{count}_r{remainder}')} PARTITION OF {qn(new_table)} "
+            f"FOR VALUES WITH (MODULUS {count}, REMAINDER {remainder})"
+        )
+    cursor.execute(f"INSERT INTO {qn(new_table)} ({columns}) SELECT {columns} FROM {qn(table)}")
+
+    cursor.execute(f"DROP TABLE {qn(table)}")
+    cursor.execute(f"ALTER TABLE {qn(new_table)} RENAME TO {qn(table)}")
+    cursor.execute(f"ALTER SEQUENCE {qn(sequence)} OWNED BY {qn(table)}.id")
+    for indexdef in indexes:
+        cursor.execute(indexdef)
+    # Lookups by id alone (instance saves and deletes) still use an index,
+    # one probe per partition
+    cursor.execute(f"CREATE INDEX {qn(table + '_id_tenant')} ON {qn(table)} (id)")
+    for name, definition in constraints:
+        cursor.execute(f"ALTER TABLE {qn(table)} ADD CONSTRAINT {qn(name)} {definition}")
+
+
+def partition(apps, schema_editor):
+    # Declarative partitioning is PostgreSQL-only; other backends keep plain tables
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    qn = schema_editor.quote_name
+    count = getattr(settings, 'HEALTH_TENANT_PARTITIONS', 8)
+    patients, mappings = TENANT_TABLES
+    with schema_editor.connection.cursor() as cursor:
+        # On a partitioned table id alone can't be unique, so mappings
+        # reference patients through the (owner, id) primary key instead
+        cursor.execute(
+            "SELECT conname FROM pg_constraint WHERE contype = 'f' "
+            "AND conrelid = %s::regclass AND confrelid = %s::regclass", [mappings, patients]
+        )
+        for (name,) in cursor.fetchall():
+            cursor.execute(f"ALTER TABLE {qn(mappings)} DROP CONSTRAINT {qn(name)}")
+        for table, key in TENANT_TABLES.items():
+            cursor.execute(
+                "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+                "WHERE c.relname = %s AND pg_table_is_visible(c.oid)", [table]
+            )
+            if cursor.fetchone() is None:
+                partition_table(schema_editor, cursor, table, key, count)
+        cursor.execute(
+            f"ALTER TABLE {qn(mappings)} ADD CONSTRAINT {qn(mappings + '_patient_tenant_fk')} "
+            f"FOREIGN KEY (owner_id, patient_id) REFERENCES {qn(patients)} (created_by_id, id) "
+            f"DEFERRABLE INITIALLY DEFERRED"
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health', '0004_mapping_owner'),
+    ]
+
+    # Irreversible: rebuilding plain tables is left to a manual restore
+    operations = [
+        migrations.RunPython(partition),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-19 05:46
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def expire_running_jobs(apps, schema_editor):
+    # Jobs left running by workers from before leases existed get one
+    # more attempt from the new workers
+    Job = apps.get_model('health', 'Job')
+    Job.objects.filter(status='running').update(lease_expires_at=timezone.now(), attempts=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health', '0006_revokedtoken'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(expire_running_jobs, migrations.RunPython.noop),
+    ]
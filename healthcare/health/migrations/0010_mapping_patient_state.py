@@ -0,0 +1,25 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health', '0009_owner_deletion'),
+    ]
+
+    # On PostgreSQL, 0005 replaced the mapping -> patient foreign key with a
+    # composite (owner_id, patient_id) one. State only: other databases keep
+    # their original constraint, and a later AlterField no longer tries to
+    # drop or recreate a constraint PostgreSQL doesn't have
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='patientdoctormapping',
+                    name='patient',
+                    field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='health.patient'),
+                ),
+            ],
+        ),
+    ]
@@ -1,7 +1,61 @@
-from django.db import models
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models.signals import post_save, pre_delete
 from django.contrib.auth.models import User
+from django.dispatch import Signal, receiver
+from django.utils import timezone
 
-class Patient(models.Model):
+# Sent with `queryset` just before SoftDeleteQuerySet.delete() flags its rows;
+# queryset.update() sends no other signal
+pre_soft_delete = Signal()
+
+
+class SoftDeleteQuerySet(models.QuerySet):
+    def delete(self):
+        # Flag rows instead of deleting them; purge_deleted removes
+        # them later in small batches. Cascades follow CASCADE relations to
+        # other soft-delete models.
+        now = timezone.now()
+        with transaction.atomic():
+            for rel in self.model._meta.related_objects:
+                if rel.on_delete is models.CASCADE and issubclass(rel.related_model, SoftDeleteModel):
+                    rel.related_model.objects.filter(**{f"{rel.field.name}__in": self}).delete()
+            pre_soft_delete.send(sender=self.model, queryset=self)
+            count = self.update(deleted_at=now)
+        return count, {self.model._meta.label: count}
+
+    def hard_delete(self):
+        return super().delete()
+
+    def alive(self):
+        return self.filter(deleted_at__isnull=True)
+
+    def dead(self):
+        return self.filter(deleted_at__isnull=False)
+
+
+class SoftDeleteManager(models.Manager.from_queryset(SoftDeleteQuerySet)):
+    def get_queryset(self):
+        return super().get_queryset().alive()
+
+
+class SoftDeleteModel(models.Model):
+    deleted_at = models.DateTimeField(null=True, blank=True, db_index=True, editable=False)
+
+    # Default manager hides deleted rows; all_objects sees everything
+    objects = SoftDeleteManager()
+    all_objects = models.Manager.from_queryset(SoftDeleteQuerySet)()
+
+    class Meta:
+        abstract = True
+
+    def delete(self, using=None, keep_parents=False):
+        return type(self).objects.filter(pk=self.pk).delete()
+
+    def hard_delete(self, using=None, keep_parents=False):
+        return super().delete(using=using, keep_parents=keep_parents)
+
+
+class Patient(SoftDeleteModel):
     name = models.CharField(max_length=100)
     age = models.IntegerField()
     GENDER_CHOICES = [
@@ -11,21 +65,201 @@ class Patient(models.Model):
 ]
 
     gender = models.CharField(max_length=10, choices=GENDER_CHOICES)
-    created_by = models.ForeignKey(User, on_delete=models.CASCADE)
+    # Deleting the owner soft-deletes their patients (see below) and leaves
+    # the rows for purge_deleted, so no cascade and no database constraint
+    created_by = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False)
 
     def __str__(self):
         return self.name
 
-class Doctor(models.Model):
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_created_by_id = instance.__dict__.get('created_by_id')
+        return instance
+
+    def save(self, *args, **kwargs):
+        # Mappings carry a copy of the owner (and on PostgreSQL live in the
+        # owner's partition), so a patient can't change hands once saved
+        loaded = getattr(self, '_loaded_created_by_id', None)
+        if loaded is not None and self.created_by_id != loaded:
+            raise ValueError("A patient's owner cannot be changed")
+        super().save(*args, **kwargs)
+
+
+@receiver(pre_delete, sender=User)
+def soft_delete_owned_patients(sender, instance, **kwargs):
+    # The delete collector would hard-delete a whole tenant in the request;
+    # flag it instead (mappings follow) and let purge_deleted batch it later
+    Patient.objects.filter(created_by=instance).delete()
+
+class Doctor(SoftDeleteModel):
     name = models.CharField(max_length=100)
     specialty = models.CharField(max_length=100)
 
     def __str__(self):
         return self.name
 
-class PatientDoctorMapping(models.Model):
-    patient = models.ForeignKey(Patient, on_delete=models.CASCADE)
+class PatientDoctorMappingManager(SoftDeleteManager):
+    CREATED = 'created'
+    DUPLICATE = 'duplicate'
+    PATIENT_NOT_FOUND = 'patient_not_found'
+    DOCTOR_NOT_FOUND = 'doctor_not_found'
+
+    def create_for_owner(self, patient_id, doctor_id, owner):
+        """
+        Insert a mapping only if the patient belongs to `owner` and the doctor
+        exists, relying on the unique constraint instead of a prior lookup.
+        Returns (status, mapping); mapping is None unless status is CREATED.
+        """
+        mapping_table = self.model._meta.db_table
+        patient_table = Patient._meta.db_table
+        doctor_table = Doctor._meta.db_table
+        qn = connection.ops.quote_name
+
+        # Both joined rows must exist, so a missing doctor never reaches the
+        # (deferred) foreign key check. A soft-deleted mapping for the pair is
+        # revived; a live one is left alone and reported as a duplicate.
+        insert_sql = (
+            f"INSERT INTO {qn(mapping_table)} (owner_id, patient_id, doctor_id) "
+            f"SELECT p.created_by_id, p.id, d.id FROM {qn(patient_table)} p, {qn(doctor_table)} d "
+            f"WHERE p.id = %s AND p.created_by_id = %s AND d.id = %s "
+            f"AND p.deleted_at IS NULL AND d.deleted_at IS NULL "
+            f"ON CONFLICT (owner_id, patient_id, doctor_id) DO UPDATE SET deleted_at = NULL "
+            f"WHERE {qn(mapping_table)}.deleted_at IS NOT NULL RETURNING id"
+        )
+        params = [patient_id, owner.pk, doctor_id]
+
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                if connection.vendor == 'postgresql':
+                    # One round trip: the status comes back with the insert
+                    cursor.execute(
+                        f"WITH ins AS ({insert_sql}) SELECT "
+                        f"(SELECT id FROM ins), "
+                        f"EXISTS(SELECT 1 FROM {qn(patient_table)} "
+                        f"WHERE id = %s AND created_by_id = %s AND deleted_at IS NULL), "
+                        f"EXISTS(SELECT 1 FROM {qn(doctor_table)} WHERE id = %s AND deleted_at IS NULL)",
+                        params + [patient_id, owner.pk, doctor_id]
+                    )
+                    mapping_id, patient_ok, doctor_ok = cursor.fetchone()
+                elif connection.vendor == 'sqlite':
+                    cursor.execute(insert_sql, params)
+                    row = cursor.fetchone()
+                    mapping_id = row[0] if row else None
+                    patient_ok = doctor_ok = True
+                    if mapping_id is None:
+                        # Only the failure path pays for working out why
+                        patient_ok = Patient.objects.filter(id=patient_id, created_by=owner).exists()
+                        doctor_ok = Doctor.objects.filter(id=doctor_id).exists()
+                else:
+                    mapping_id, patient_ok, doctor_ok = self._create_for_owner_fallback(
+                        patient_id, doctor_id, owner
+                    )
+        except IntegrityError:
+            # The doctor was deleted between the insert and the commit
+            return self.DOCTOR_NOT_FOUND, None
+
+        if not patient_ok:
+            return self.PATIENT_NOT_FOUND, None
+        if not doctor_ok:
+            return self.DOCTOR_NOT_FOUND, None
+        if mapping_id is None:
+            return self.DUPLICATE, None
+        mapping = self.model(id=mapping_id, patient_id=patient_id, doctor_id=doctor_id, owner_id=owner.pk)
+        if connection.vendor in ('postgresql', 'sqlite'):
+            # The raw INSERT bypassed save(); listeners (e.g. the change stream) still need to hear of it
+            post_save.send(sender=self.model, instance=mapping, created=True, update_fields=None,
+                           raw=False, using=connection.alias)
+        return self.CREATED, mapping
+
+    def _create_for_owner_fallback(self, patient_id, doctor_id, owner):
+        # Backends without INSERT ... ON CONFLICT
+        patient_ok = Patient.objects.filter(id=patient_id, created_by=owner).exists()
+        doctor_ok = Doctor.objects.filter(id=doctor_id).exists()
+        if not (patient_ok and doctor_ok):
+            return None, patient_ok, doctor_ok
+        try:
+            with transaction.atomic():
+                mapping = self.create(patient_id=patient_id, doctor_id=doctor_id, owner=owner)
+        except IntegrityError:
+            revived = self.model.all_objects.dead().filter(patient_id=patient_id, doctor_id=doctor_id)
+            mapping_id = revived.values_list('id', flat=True).first()
+            if mapping_id is None or not revived.update(deleted_at=None):
+                return None, True, True
+            return mapping_id, True, True
+        return mapping.id, True, True
+
+
+class PatientDoctorMapping(SoftDeleteModel):
+    # On PostgreSQL the database enforces this through the (owner, patient)
+    # foreign key added by migration 0005 instead; see migration 0010
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, db_constraint=False)
     doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE)
+    # Copy of patient.created_by: the tenant key the table is partitioned by
+    # on PostgreSQL (see health.partitioning). The unique index leads with it.
+    owner = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, editable=False, db_index=False)
+
+    objects = PatientDoctorMappingManager()
+
+    class Meta:
+        # Partitioned tables need the partition key in every unique constraint;
+        # a patient has one owner, so this is still one mapping per pair
+        unique_together = ('owner', 'patient', 'doctor')
+
+    def save(self, *args, **kwargs):
+        if self.owner_id is None or 'patient' in self._state.fields_cache:
+            self.owner_id = self.patient.created_by_id
+        super().save(*args, **kwargs)
+
+
+class Job(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    ]
+
+    kind = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    progress = models.PositiveSmallIntegerField(default=0)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=100, blank=True)
+    created_by = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Renewed by the running worker; once it lapses the job can be reclaimed
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
 
     class Meta:
-        unique_together = ('patient', 'doctor')
+        # Workers scan for the oldest queued job
+        indexes = [models.Index(fields=['status', 'id'])]
+
+    def __str__(self):
+        return f"{self.kind} #{self.pk} ({self.status})"
+
+    def report_progress(self, percent):
+        # Single-column UPDATE so handlers can call this often
+        self.progress = max(0, min(100, int(percent)))
+        Job.objects.filter(pk=self.pk).update(progress=self.progress)
+
+
+class RevokedToken(models.Model):
+    # Revoked JWTs by jti; rows are only needed until the token expires
+    jti = models.CharField(max_length=255, unique=True)
+    user = models.ForeignKey(User, null=True, blank=True, on_delete=models.CASCADE)
+    expires_at = models.DateTimeField(db_index=True)
+    # Workers fetch new revocations by this
+    revoked_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return self.jti
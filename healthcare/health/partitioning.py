@@ -0,0 +1,131 @@
+import re
+
+from django.db import connection
+
+# PostgreSQL hash partitioning of the per-tenant tables, which migration
+# 0005 set up. Patients come first: mappings reference them.
+TENANT_TABLES = {
+    'health_patient': 'created_by_id',
+    'health_patientdoctormapping': 'owner_id',
+}
+
+BOUND_RE = re.compile(r"modulus (\d+), remainder (\d+)", re.IGNORECASE)
+PARTITION_RE = re.compile(r"\b(health_\w+?_m\d+_r\d+)\b")
+
+
+def partition_name(table, modulus, remainder):
+    return f"{table}_m{modulus}_r{remainder}"
+
+
+def is_partitioned(cursor, table):
+    cursor.execute(
+        "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+        "WHERE c.relname = %s AND pg_table_is_visible(c.oid)", [table]
+    )
+    return cursor.fetchone() is not None
+
+
+def partitions(cursor, table):
+    """Return [(name, modulus, remainder, estimated_rows)] for a partitioned table."""
+    cursor.execute(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), c.reltuples "
+        "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = %s::regclass", [table]
+    )
+    rows = []
+    for name, bound, tuples in cursor.fetchall():
+        modulus, remainder = map(int, BOUND_RE.search(bound).groups())
+        # reltuples is -1 until the partition has been analyzed
+        rows.append((name, modulus, remainder, max(int(tuples), 0)))
+    return sorted(rows, key=lambda row: (row[1], row[2]))
+
+
+def _columns(cursor, table):
+    cursor.execute(
+        "SELECT attname FROM pg_attribute WHERE attrelid = %s::regclass "
+        "AND attnum > 0 AND NOT attisdropped ORDER BY attnum", [table]
+    )
+    return ', '.join(connection.ops.quote_name(row[0]) for row in cursor.fetchall())
+
+
+def referencing_foreign_keys(cursor, table):
+    """Return [(table, name, definition)] for the foreign keys pointing at `table`."""
+    # conparentid = 0: the partitioned tables' own constraints, not the
+    # copies PostgreSQL keeps for each partition
+    cursor.execute(
+        "SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE contype = 'f' AND confrelid = %s::regclass AND conparentid = 0", [table]
+    )
+    return cursor.fetchall()
+
+
+def split_partition(cursor, table, name, lock_timeout='5s'):
+    """
+    Split hash partition `name` (modulus m, remainder r) into (2m, r) and
+    (2m, r + m) and move its rows across. Only that partition's rows are
+    copied, but this is not an online operation: DETACH holds an ACCESS
+    EXCLUSIVE lock on the whole table, blocking every tenant's reads and
+    writes, until the transaction commits. Foreign keys pointing at the
+    table (mappings -> patients) are dropped for the move and re-added,
+    which re-checks every row of the referencing table under its lock too.
+    Must run inside a transaction. Returns the new partition names.
+    """
+    qn = connection.ops.quote_name
+    bounds = {row[0]: row for row in partitions(cursor, table)}
+    if name not in bounds:
+        raise ValueError(f"{name} is not a partition of {table}")
+    _, modulus, remainder, _ = bounds[name]
+    columns = _columns(cursor, table)
+
+    # Fail fast rather than queue behind long transactions and block everyone
+    cursor.execute("SELECT set_config('lock_timeout', %s, true)", [lock_timeout])
+    # ALTER TABLE refuses to run with deferred FK checks still pending
+    cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+    # A referenced partition can't be detached while rows point into it
+    foreign_keys = referencing_foreign_keys(cursor, table)
+    # Take every lock the split needs up front, so a busy table fails the
+    # lock timeout before any work is done rather than halfway through
+    for locked in [referencing for referencing, _, _ in foreign_keys] + [table]:
+        cursor.execute(f"LOCK TABLE {qn(locked)} IN ACCESS EXCLUSIVE MODE")
+    for referencing, constraint, _ in foreign_keys:
+        cursor.execute(f"ALTER TABLE {qn(referencing)} DROP CONSTRAINT {qn(constraint)}")
+    cursor.execute(f"ALTER TABLE {qn(table)} DETACH PARTITION {qn(name)}")
+    created = []
+    for new_remainder in (remainder, remainder + modulus):
+        child = partition_name(table, modulus * 2, new_remainder)
+        cursor.execute(
+            f"CREATE TABLE {qn(child)} PARTITION OF {qn(table)} "
+            f"FOR VALUES WITH (MODULUS {modulus * 2}, REMAINDER {new_remainder})"
+        )
+        created.append(child)
+    cursor.execute(f"INSERT INTO {qn(table)} ({columns}) SELECT {columns} FROM {qn(name)}")
+    cursor.execute(f"DROP TABLE {qn(name)}")
+    for referencing, constraint, definition in foreign_keys:
+        cursor.execute(f"ALTER TABLE {qn(referencing)} ADD CONSTRAINT {qn(constraint)} {definition}")
+    cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+    return created
+
+
+def pruning_report(user):
+    """
+    EXPLAIN the tenant-scoped queries the API issues for `user` and return
+    {label: [partitions in the plan]}. With pruning each lists one partition.
+    """
+    from .models import Doctor, Patient, PatientDoctorMapping
+
+    patient_id = Patient.objects.filter(created_by=user).values_list('id', flat=True).first() or 0
+    queries = {
+        'patient list': Patient.objects.filter(created_by=user),
+        'patient detail': Patient.objects.filter(created_by=user, id=patient_id),
+        'mapping list': PatientDoctorMapping.objects.filter(owner=user),
+        'expand doctors': PatientDoctorMapping.objects.filter(owner=user, patient__in=[patient_id]),
+        'doctors for patient': Doctor.objects.filter(
+            patientdoctormapping__owner=user,
+            patientdoctormapping__patient=patient_id,
+            patientdoctormapping__deleted_at__isnull=True,
+        ),
+    }
+    return {
+        label: sorted(set(PARTITION_RE.findall(queryset.explain())))
+        for label, queryset in queries.items()
+    }
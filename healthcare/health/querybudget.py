@@ -0,0 +1,78 @@
+import re
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%s|\?")
+_IN_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_SAVEPOINTS = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+
+def sql_shape(sql):
+    """The statement with literals and parameters replaced by ?, so repeats compare equal."""
+    return _IN_LISTS.sub('(?)', _LITERALS.sub('?', sql))
+
+
+def counted(statements):
+    # Savepoints are transaction bookkeeping, not queries
+    return [sql for sql in statements if not sql.startswith(_SAVEPOINTS)]
+
+
+def repeated_shapes(statements, threshold=2):
+    counts = Counter(sql_shape(sql) for sql in counted(statements))
+    return {shape: count for shape, count in counts.most_common() if count >= threshold}
+
+
+@contextmanager
+def query_budget(max_queries, using='default'):
+    """
+    Fail if the block runs more than `max_queries` queries, listing them with
+    any repeated statement shapes (the usual N+1 signature) first.
+    """
+    # Imported here: the middleware uses this module outside of tests
+    from django.test.utils import CaptureQueriesContext
+
+    with CaptureQueriesContext(connections[using]) as context:
+        yield context
+    statements = counted(q['sql'] for q in context.captured_queries)
+    if len(statements) > max_queries:
+        lines = [f"{len(statements)} queries exceed the budget of {max_queries}"]
+        lines += [f"  repeated {count}x: {shape}" for shape, count in repeated_shapes(statements).items()]
+        lines += [f"  {number}. {sql}" for number, sql in enumerate(statements, start=1)]
+        raise AssertionError("\n".join(lines))
+
+
+def call_site():
+    # The project's own frames (not Django's or this module's) that led here
+    base = str(settings.BASE_DIR)
+    return [
+        frame for frame in traceback.extract_stack()[:-1]
+        if frame.filename.startswith(base) and 'site-packages' not in frame.filename
+        and frame.filename != __file__
+    ]
+
+
+class QueryRecorder:
+    """
+    connection.execute_wrapper() that counts statements by shape and keeps
+    the stack of the first repeat of each, for N+1 reports.
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self.sites = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        if not sql.startswith(_SAVEPOINTS):
+            shape = sql_shape(sql)
+            self.counts[shape] += 1
+            if self.counts[shape] == 2:
+                self.sites[shape] = call_site()
+        return execute(sql, params, many, context)
+
+    def repeated(self, threshold):
+        return [(shape, count, self.sites.get(shape, []))
+                for shape, count in self.counts.most_common() if count >= threshold]
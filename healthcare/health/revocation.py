@@ -0,0 +1,130 @@
+import math
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import datetime_from_epoch
+
+from .models import RevokedToken
+
+MASK64 = (1 << 64) - 1
+
+
+class BloomFilter:
+    """
+    Fixed-size bloom filter of strings. Positions come from Python's hash(),
+    which is salted per process, so a filter must never leave its process.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = max(int(capacity), 1)
+        self.size = max(64, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def add(self, value):
+        if value in self:
+            return  # refreshes overlap, so don't count a member twice
+        # Double hashing: the two halves of one 64-bit hash give every position
+        h = hash(value) & MASK64
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        for i in range(self.hashes):
+            position = (h1 + i * h2) % self.size
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        h = hash(value) & MASK64
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        bits, size = self.bits, self.size
+        for i in range(self.hashes):
+            position = (h1 + i * h2) % size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class RevocationList:
+    """
+    This process's view of RevokedToken: a bloom filter of the unexpired
+    revoked JTIs. Rows added by other workers are fetched at most every
+    HEALTH_REVOCATION_REFRESH seconds, by revoked_at, reaching back
+    HEALTH_REVOCATION_OVERLAP seconds before the previous fetch so rows
+    that committed late are still seen. Every HEALTH_REVOCATION_REBUILD
+    seconds the filter is rebuilt so expired entries fall out. A JTI the
+    filter rules out is not revoked; a probable hit is confirmed against
+    the table.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._filter = None
+        self._synced_at = None
+        self._refreshed_at = 0.0
+        self._rebuilt_at = 0.0
+
+    def is_revoked(self, jti):
+        now = time.monotonic()
+        if self._filter is None or now - self._refreshed_at >= getattr(settings, 'HEALTH_REVOCATION_REFRESH', 5):
+            self._refresh(now)
+        if jti not in self._filter:
+            return False
+        return RevokedToken.objects.filter(jti=jti).exists()
+
+    def add(self, jti):
+        # Visible to this worker at once; others pick it up on their next refresh
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(jti)
+
+    def reset(self):
+        with self._lock:
+            self._filter = None
+            self._synced_at = None
+
+    def _refresh(self, now):
+        with self._lock:
+            if self._filter is not None and now - self._refreshed_at < getattr(settings, 'HEALTH_REVOCATION_REFRESH', 5):
+                return  # another thread got here first
+            if (self._filter is None or self._filter.count > self._filter.capacity
+                    or now - self._rebuilt_at >= getattr(settings, 'HEALTH_REVOCATION_REBUILD', 300)):
+                self._rebuild(now)
+            else:
+                # revoked_at is stamped before commit; the overlap covers rows
+                # that became visible after a later fetch had already run
+                synced_at = timezone.now()
+                since = self._synced_at - timedelta(seconds=getattr(settings, 'HEALTH_REVOCATION_OVERLAP', 60))
+                for jti in RevokedToken.objects.filter(revoked_at__gte=since).values_list('jti', flat=True):
+                    self._filter.add(jti)
+                self._synced_at = synced_at
+            self._refreshed_at = now
+
+    def _rebuild(self, now):
+        synced_at = timezone.now()
+        jtis = list(RevokedToken.objects.filter(expires_at__gt=synced_at).values_list('jti', flat=True))
+        bloom = BloomFilter(
+            max(getattr(settings, 'HEALTH_REVOCATION_CAPACITY', 10000), 2 * len(jtis)),
+            getattr(settings, 'HEALTH_REVOCATION_ERROR_RATE', 0.001),
+        )
+        for jti in jtis:
+            bloom.add(jti)
+        self._filter = bloom
+        self._synced_at = synced_at
+        self._rebuilt_at = now
+
+
+revocations = RevocationList()
+
+
+def revoke(token):
+    """Revoke a validated simplejwt token until it expires."""
+    jti = token[api_settings.JTI_CLAIM]
+    RevokedToken.objects.get_or_create(jti=jti, defaults={
+        'user_id': token.get(api_settings.USER_ID_CLAIM),
+        'expires_at': datetime_from_epoch(token['exp']),
+    })
+    revocations.add(jti)
@@ -1,6 +1,36 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
-from .models import Patient, Doctor, PatientDoctorMapping
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from .models import Patient, Doctor, PatientDoctorMapping, Job
+from .jobs import registry as job_registry
+from .revocation import revocations, revoke
+
+def requested_fields(request):
+    # Sparse fieldsets: ?fields=id,name on GET requests
+    if request is None or request.method != 'GET':
+        return None
+    value = request.query_params.get('fields')
+    if not value:
+        return None
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+def requested_expansions(request):
+    # Related data to embed: ?expand=doctors
+    if request is None or request.method != 'GET':
+        return set()
+    value = request.query_params.get('expand', '')
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+class SparseFieldsetMixin:
+    # Drop every field not named in ?fields= from the output
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = requested_fields(self.context.get('request'))
+        if fields:
+            for name in set(self.fields) - fields:
+                self.fields.pop(name)
 
 class RegisterSerializer(serializers.ModelSerializer):
     class Meta:
@@ -16,18 +46,73 @@ class RegisterSerializer(serializers.ModelSerializer):
         )
         return user
 
-class PatientSerializer(serializers.ModelSerializer):
+class RevocableTokenRefreshSerializer(TokenRefreshSerializer):
+    # Refuse revoked refresh tokens, and revoke the old one when rotating
+    # (BLACKLIST_AFTER_ROTATION without the token_blacklist app)
+    def validate(self, attrs):
+        refresh = self.token_class(attrs['refresh'])
+        if revocations.is_revoked(refresh[api_settings.JTI_CLAIM]):
+            raise TokenError("Token has been revoked")
+        data = super().validate(attrs)
+        if api_settings.ROTATE_REFRESH_TOKENS and api_settings.BLACKLIST_AFTER_ROTATION:
+            revoke(refresh)
+        return data
+
+class LogoutSerializer(serializers.Serializer):
+    # Optional: the refresh token to revoke along with the access token in use
+    refresh = serializers.CharField(required=False)
+
+class PatientSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Patient
-        fields = '__all__'
+        exclude = ('deleted_at',)
         read_only_fields = ('created_by',)
 
-class DoctorSerializer(serializers.ModelSerializer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        fields = requested_fields(request)
+        if 'doctors' in requested_expansions(request) and (not fields or 'doctors' in fields):
+            self.fields['doctors'] = serializers.SerializerMethodField()
+
+    def get_doctors(self, obj):
+        # Reads the mappings prefetched by PatientViewSet (with their doctors)
+        doctors = [mapping.doctor for mapping in obj.patientdoctormapping_set.all()]
+        return DoctorSerializer(doctors, many=True).data
+
+class DoctorSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Doctor
-        fields = '__all__'
+        exclude = ('deleted_at',)
 
 class PatientDoctorMappingSerializer(serializers.ModelSerializer):
     class Meta:
         model = PatientDoctorMapping
-        fields = '__all__'
+        exclude = ('deleted_at', 'owner')
+
+class PatientDoctorMappingCreateSerializer(serializers.Serializer):
+    # Input only: the ids are checked against the database by the INSERT itself
+    patient = serializers.IntegerField(min_value=1)
+    doctor = serializers.IntegerField(min_value=1)
+
+class JobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Job
+        fields = ('id', 'kind', 'payload', 'status', 'progress', 'result', 'error',
+                  'created_at', 'started_at', 'finished_at')
+        read_only_fields = ('status', 'progress', 'result', 'error',
+                            'created_at', 'started_at', 'finished_at')
+
+    def validate_kind(self, value):
+        if value not in job_registry:
+            raise serializers.ValidationError("Unknown job kind")
+        _, staff_only = job_registry[value]
+        if staff_only and not self.context['request'].user.is_staff:
+            raise serializers.ValidationError("Only staff can start this job")
+        return value
+
+
+class JobListSerializer(JobSerializer):
+    # Results (e.g. a whole export) can be large; only the detail returns them
+    class Meta(JobSerializer.Meta):
+        fields = tuple(name for name in JobSerializer.Meta.fields if name != 'result')
@@ -0,0 +1,62 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.checks import Tags, run_checks
+from django.core.exceptions import ImproperlyConfigured
+from django.urls import get_resolver
+from rest_framework import serializers as drf_serializers
+
+logger = logging.getLogger(__name__)
+
+
+def prewarm():
+    """
+    Do the lazy work Django and DRF would otherwise leave for the first
+    request: build the URL resolver's reverse maps and bind every
+    serializer's fields. Returns per-step timings.
+
+    The database connection is deliberately left alone: with the default
+    CONN_MAX_AGE of 0 it would be closed when the first request starts, and
+    under a preloading server it would be inherited across fork().
+    """
+    timings = {}
+
+    started = time.perf_counter()
+    resolver = get_resolver()
+    resolver.reverse_dict  # populates the resolver, including included URLconfs
+    timings['urls'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    from health import serializers
+    for value in vars(serializers).values():
+        if (isinstance(value, type) and issubclass(value, drf_serializers.Serializer)
+                and value.__module__ == serializers.__name__):
+            value().fields
+    timings['serializers'] = time.perf_counter() - started
+
+    return timings
+
+
+def check_caches():
+    """
+    Refuse to boot with a cache backend that can't be loaded. Servers such
+    as gunicorn and uvicorn don't run system checks themselves.
+    """
+    errors = [error for error in run_checks(tags=[Tags.caches]) if error.is_serious()]
+    if errors:
+        raise ImproperlyConfigured("\n".join(str(error) for error in errors))
+
+
+def prewarm_if_enabled(booted_at=None):
+    if not getattr(settings, 'HEALTH_PREWARM', False):
+        return None
+    timings = prewarm()
+    if booted_at is not None:
+        ready = time.perf_counter() - booted_at
+        timings['total'] = ready
+        target = getattr(settings, 'HEALTH_STARTUP_TARGET_SECONDS', None)
+        if target is not None and ready > target:
+            logger.warning("Worker took %.2fs to become ready (target %.2fs)", ready, target)
+    logger.info("Prewarm timings: %s", {k: round(v, 4) for k, v in timings.items()})
+    return timings
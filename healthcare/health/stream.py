@@ -0,0 +1,118 @@
+import asyncio
+import json
+import secrets
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+
+from .authentication import RevocableJWTAuthentication
+from .events import TooManyStreams, broker
+
+
+def _ticket_cache():
+    return caches[getattr(settings, 'HEALTH_STREAM_TICKET_CACHE', 'default')]
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def stream_ticket(request):
+    """
+    POST /api/stream/ticket/: a single-use ticket for opening the change
+    stream. EventSource can't send an Authorization header and a token in
+    the query string ends up in access logs, so the stream takes this
+    short-lived ticket there instead.
+    """
+    ttl = getattr(settings, 'HEALTH_STREAM_TICKET_TTL', 30)
+    ticket = secrets.token_urlsafe(32)
+    _ticket_cache().set(f"stream-ticket:{ticket}", request.user.pk, ttl)
+    return Response({'ticket': ticket, 'expires_in': ttl}, status=status.HTTP_201_CREATED)
+
+
+def _redeem_ticket(ticket):
+    cache = _ticket_cache()
+    key = f"stream-ticket:{ticket}"
+    user_id = cache.get(key)
+    # Only the request whose delete removed the key may use it
+    if user_id is None or not cache.delete(key):
+        raise AuthenticationFailed("Stream ticket is invalid or has already been used")
+    user = User.objects.filter(pk=user_id, is_active=True).first()
+    if user is None:
+        raise AuthenticationFailed("User not found")
+    return user
+
+
+def _authenticate(request):
+    result = RevocableJWTAuthentication().authenticate(request)
+    if result is None and request.GET.get('ticket'):
+        return _redeem_ticket(request.GET['ticket'])
+    return result[0] if result else None
+
+
+def format_event(event):
+    data = json.dumps(event, cls=DjangoJSONEncoder)
+    return f"event: {event['type']}\ndata: {data}\n\n".encode()
+
+
+async def changes(request):
+    """
+    GET /api/stream/: a text/event-stream of create, update and delete events
+    for the user's patients and mappings. Authenticated by an Authorization
+    header or a `?ticket=` from stream_ticket. Starts with a `ready` event; a
+    `resync` event means events were dropped and the client should re-fetch.
+    The stream ends after HEALTH_EVENTS_MAX_AGE seconds and the client
+    reconnects, with a new ticket if it used one.
+    """
+    if request.method != 'GET':
+        return JsonResponse({"error": "Method not allowed"}, status=405)
+    if not isinstance(request, ASGIRequest):
+        # Under WSGI the response would be buffered until the stream ended
+        return JsonResponse({"error": "The change stream needs an ASGI server"}, status=501)
+
+    try:
+        user = await sync_to_async(_authenticate)(request)
+    except AuthenticationFailed as exc:
+        return JsonResponse({"detail": exc.detail}, status=401)
+    if user is None:
+        return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+
+    keepalive = getattr(settings, 'HEALTH_EVENTS_KEEPALIVE', 15)
+    max_age = getattr(settings, 'HEALTH_EVENTS_MAX_AGE', 300)
+    try:
+        queue = broker.subscribe(user.pk)
+    except TooManyStreams:
+        response = JsonResponse({"error": "Too many open streams for this user"}, status=429)
+        response['Retry-After'] = str(keepalive)
+        return response
+
+    async def stream():
+        # Django 4.2 doesn't notice a client going away, so the max age also
+        # bounds how long an abandoned stream stays subscribed
+        deadline = time.monotonic() + max_age
+        try:
+            yield b"retry: 3000\n" + format_event({'type': 'ready'})
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=min(keepalive, remaining))
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+                    continue
+                yield format_event(event)
+        finally:
+            broker.unsubscribe(user.pk, queue)
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -4,8 +4,45 @@ from django.contrib.auth.models import User
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
 from rest_framework_simplejwt.tokens import RefreshToken
-from .models import Patient, Doctor, PatientDoctorMapping
+from .models import Patient, Doctor, PatientDoctorMapping, Job, RevokedToken
+import asyncio
+import hashlib
 import json
+import threading
+import gzip
+from unittest import skipIf
+from unittest import mock
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.redis import RedisCache
+from django.http import HttpResponse
+from django.test import AsyncClient, AsyncRequestFactory, RequestFactory, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import IntegrityError, connection, transaction
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from datetime import timedelta
+from io import StringIO
+from .idempotency import RELEASE_LOCK_SCRIPT, _release_lock
+from .throttling import TokenBucketStore, limit_endpoint, rate_buckets
+from .admin import EstimatedCountPaginator
+from .middleware import brotli
+from .startup import check_caches, prewarm, prewarm_if_enabled
+from .checks import check_cache_backends
+from .management.commands.profile_startup import parse_importtime
+from .jobs import claim_next, enqueue, register_job, registry as job_registry
+from .partitioning import partitions, pruning_report, referencing_foreign_keys
+from .events import broker
+from .revocation import BloomFilter, revocations
+from .querybudget import query_budget, sql_shape
+from .middleware import NPlusOneMiddleware
+from .urls import router
+from .batch import _dispatch_in_thread
+from .views import PatientViewSet
+from .management.commands.bench_scaling import efficiency
+from asgiref.sync import async_to_sync, sync_to_async
 
 class AuthenticationTests(APITestCase):
     """Test user registration and authentication"""
@@ -434,4 +471,1435 @@ class UnauthenticatedAccessTests(APITestCase):
             if endpoint not in [self.patient_detail_url, self.doctor_detail_url]:
                 # Also test POST on list endpoints
                 response = self.client.post(endpoint, {}, format='json')
-                self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
\ No newline at end of file
+                self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class ThrottlingTests(APITestCase):
+    """Test token-bucket throttling and concurrency load shedding"""
+
+    def setUp(self):
+        cache.clear()
+        self.register_url = reverse('register')
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_token_bucket_empties_and_reports_wait(self):
+        """Test that a bucket allows its burst and then reports a wait"""
+        store = TokenBucketStore()
+        self.assertEqual(store.consume('test-bucket', 2, 60), 0)
+        self.assertEqual(store.consume('test-bucket', 2, 60), 0)
+        self.assertGreater(store.consume('test-bucket', 2, 60), 0)
+
+    def test_burst_caps_bucket_without_lowering_rate(self):
+        """Test that 20/hour with a burst of 5 refills faster than 5/hour"""
+        store = TokenBucketStore()
+        buckets = rate_buckets('test-burst', '20/hour', 5)
+        start = 3600 * 1000
+        with mock.patch('health.throttling.time.time', return_value=start):
+            for _ in range(5):
+                self.assertEqual(store.consume_all(buckets), 0)
+            self.assertGreater(store.consume_all(buckets), 0)
+
+        # Half an hour later a whole new burst fits; 5/hour would refuse most of it
+        with mock.patch('health.throttling.time.time', return_value=start + 1800):
+            for _ in range(5):
+                self.assertEqual(store.consume_all(buckets), 0)
+
+    def test_refused_request_charges_no_bucket(self):
+        """Test that a bucket refusing the request refunds the other buckets"""
+        store = TokenBucketStore()
+        self.assertEqual(store.consume_all([('test-ip', 2, 60), ('test-user', 1, 60)]), 0)
+        for _ in range(3):
+            self.assertGreater(store.consume_all([('test-ip', 2, 60), ('test-user', 1, 60)]), 0)
+        self.assertEqual(store.consume('test-ip', 2, 60), 0)
+
+    def test_register_throttled_per_ip(self):
+        """Test that registration bursts from one IP get a 429"""
+        for _ in range(5):
+            response = self.client.post(self.register_url, {}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(self.register_url, {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn('Retry-After', response)
+
+        # Another client IP still has its own bucket
+        response = self.client.post(self.register_url, {}, format='json', REMOTE_ADDR='10.0.0.2')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_forwarded_for_does_not_pick_bucket(self):
+        """Test that rotating X-Forwarded-For does not escape the per-IP bucket"""
+        for attempt in range(5):
+            response = self.client.post(self.register_url, {}, format='json',
+                                        HTTP_X_FORWARDED_FOR=f'203.0.113.{attempt}')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(self.register_url, {}, format='json', HTTP_X_FORWARDED_FOR='203.0.113.99')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_token_bucket_falls_back_to_local_cache(self):
+        """Test that buckets still fill when the shared cache is unusable"""
+        store = TokenBucketStore(alias='missing')
+        self.assertEqual(store.consume('test-bucket', 1, 60), 0)
+        self.assertGreater(store.consume('test-bucket', 1, 60), 0)
+
+    def test_concurrency_limit_sheds_with_503(self):
+        """Test that requests beyond max_concurrent are shed with Retry-After"""
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_view(request):
+            started.set()
+            release.wait(5)
+            return HttpResponse('ok')
+
+        view = limit_endpoint(slow_view, 'slow', {'max_concurrent': 1, 'retry_after': 3})
+        factory = RequestFactory()
+        worker = threading.Thread(target=view, args=(factory.get('/slow/'),))
+        worker.start()
+        started.wait(5)
+
+        response = view(factory.get('/slow/'))
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '3')
+
+        release.set()
+        worker.join()
+        response = view(factory.get('/slow/'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class IdempotencyTests(APITestCase):
+    """Test Idempotency-Key replay on patient and mapping creation"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='securepassword123'
+        )
+        refresh = RefreshToken.for_user(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
+
+        self.doctor = Doctor.objects.create(
+            name='Dr. Jane Smith',
+            specialty='Cardiology'
+        )
+        self.patients_url = reverse('patient-list')
+        self.mappings_url = reverse('mapping-list')
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_patient_retry_is_replayed(self):
+        """Test that retrying a patient POST returns the first response"""
+        data = {'name': 'Alice Brown', 'age': 30, 'gender': 'Female'}
+
+        first = self.client.post(self.patients_url, data, format='json', HTTP_IDEMPOTENCY_KEY='abc')
+        second = self.client.post(self.patients_url, data, format='json', HTTP_IDEMPOTENCY_KEY='abc')
+
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.data['id'], first.data['id'])
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(Patient.objects.count(), 1)
+
+    def test_key_reuse_with_different_body(self):
+        """Test that reusing a key for a different payload is rejected"""
+        self.client.post(self.patients_url, {'name': 'Alice Brown', 'age': 30, 'gender': 'Female'},
+                         format='json', HTTP_IDEMPOTENCY_KEY='abc')
+        response = self.client.post(self.patients_url, {'name': 'Bob Brown', 'age': 31, 'gender': 'Male'},
+                                    format='json', HTTP_IDEMPOTENCY_KEY='abc')
+
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(Patient.objects.count(), 1)
+
+    def test_mapping_retry_is_not_a_duplicate(self):
+        """Test that a retried mapping POST replays 201 instead of failing as a duplicate"""
+        patient = Patient.objects.create(name='John Doe', age=45, gender='Male', created_by=self.user)
+        data = {'patient': patient.id, 'doctor': self.doctor.id}
+
+        first = self.client.post(self.mappings_url, data, format='json', HTTP_IDEMPOTENCY_KEY='map-1')
+        with self.assertNumQueries(1):  # only the JWT user lookup
+            second = self.client.post(self.mappings_url, data, format='json', HTTP_IDEMPOTENCY_KEY='map-1')
+
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(PatientDoctorMapping.objects.count(), 1)
+
+    def test_keys_are_scoped_per_user(self):
+        """Test that the same key from another user is processed independently"""
+        data = {'name': 'Alice Brown', 'age': 30, 'gender': 'Female'}
+        self.client.post(self.patients_url, data, format='json', HTTP_IDEMPOTENCY_KEY='abc')
+
+        other = User.objects.create_user(username='other', password='securepassword123')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(other).access_token}')
+        response = self.client.post(self.patients_url, data, format='json', HTTP_IDEMPOTENCY_KEY='abc')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn('Idempotent-Replayed', response)
+        self.assertEqual(Patient.objects.count(), 2)
+
+
+    @override_settings(HEALTH_IDEMPOTENCY_WAIT=0.1)
+    def test_concurrent_duplicate_waits_on_lock(self):
+        """Test that a duplicate arriving while the key is locked does not create a patient"""
+        data = {'name': 'Alice Brown', 'age': 30, 'gender': 'Female'}
+        with mock.patch('health.idempotency.caches') as caches:
+            caches.__getitem__.return_value.get.return_value = None
+            caches.__getitem__.return_value.add.return_value = False
+            response = self.client.post(self.patients_url, data, format='json', HTTP_IDEMPOTENCY_KEY='abc')
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(Patient.objects.count(), 0)
+
+    def test_expired_lock_taken_by_another_request_is_kept(self):
+        """Test that a slow request does not release a lock it no longer holds"""
+        digest = hashlib.sha256(f"{self.user.pk}:{self.patients_url}:slow".encode()).hexdigest()
+        lock_key = f"idempotency-lock:{digest}"
+        perform_create = PatientViewSet.perform_create
+
+        def outlive_lock(view, serializer):
+            # Our lock expired and a retry took the key while we were working
+            cache.set(lock_key, 'other-request')
+            perform_create(view, serializer)
+
+        data = {'name': 'Alice Brown', 'age': 30, 'gender': 'Female'}
+        with mock.patch.object(PatientViewSet, 'perform_create', outlive_lock):
+            response = self.client.post(self.patients_url, data, format='json', HTTP_IDEMPOTENCY_KEY='slow')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(cache.get(lock_key), 'other-request')
+
+    def test_redis_lock_released_by_compare_and_delete(self):
+        """Test that on Redis the lock is released by one atomic script call"""
+        redis_cache = RedisCache('redis://127.0.0.1:6379/0', {})
+        client = mock.Mock()
+        redis_cache.__dict__['_cache'] = mock.Mock(get_client=mock.Mock(return_value=client))
+        _release_lock(redis_cache, 'idempotency-lock:abc', 'token')
+
+        key = redis_cache.make_and_validate_key('idempotency-lock:abc')
+        client.eval.assert_called_once_with(
+            RELEASE_LOCK_SCRIPT, 1, key, redis_cache._cache._serializer.dumps.return_value
+        )
+        redis_cache._cache._serializer.dumps.assert_called_once_with('token')
+
+
+class MappingCreateRoundTripTests(APITestCase):
+    """Test that mapping creation is a single ownership-checked INSERT"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='securepassword123')
+        refresh = RefreshToken.for_user(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
+        self.patient = Patient.objects.create(name='John Doe', age=45, gender='Male', created_by=self.user)
+        self.doctor = Doctor.objects.create(name='Dr. Jane Smith', specialty='Cardiology')
+        self.mappings_url = reverse('mapping-list')
+
+    def health_queries(self, context):
+        return [q['sql'] for q in context.captured_queries if 'health_' in q['sql']]
+
+    def test_create_uses_one_statement(self):
+        """Test that a successful create touches the health tables exactly once"""
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(self.mappings_url, {
+                'patient': self.patient.id,
+                'doctor': self.doctor.id
+            }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data, {'id': response.data['id'], 'patient': self.patient.id, 'doctor': self.doctor.id})
+        self.assertEqual(len(self.health_queries(context)), 1)
+
+    def test_unknown_doctor_rejected(self):
+        """Test that a missing doctor is a 400 and nothing is inserted"""
+        response = self.client.post(self.mappings_url, {
+            'patient': self.patient.id,
+            'doctor': self.doctor.id + 100
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(PatientDoctorMapping.objects.count(), 0)
+
+    def test_invalid_ids_rejected(self):
+        """Test that non-numeric ids fail validation without hitting the database"""
+        response = self.client.post(self.mappings_url, {'patient': 'abc', 'doctor': self.doctor.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ConcurrentMappingCreateTests(TransactionTestCase):
+    """Test parallel duplicate mapping requests against a real commit"""
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest("shared-cache in-memory SQLite rejects concurrent writers outright")
+
+    def test_parallel_duplicates_create_one_mapping(self):
+        """Test that racing duplicate POSTs produce exactly one mapping"""
+        user = User.objects.create_user(username='testuser', password='securepassword123')
+        patient = Patient.objects.create(name='John Doe', age=45, gender='Male', created_by=user)
+        doctor = Doctor.objects.create(name='Dr. Jane Smith', specialty='Cardiology')
+        token = RefreshToken.for_user(user).access_token
+        url = reverse('mapping-list')
+        workers = 8
+        barrier = threading.Barrier(workers)
+        codes = []
+
+        def post():
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+            barrier.wait()
+            try:
+                response = client.post(url, {'patient': patient.id, 'doctor': doctor.id}, format='json')
+                codes.append(response.status_code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=post) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(codes.count(status.HTTP_201_CREATED), 1)
+        self.assertEqual(codes.count(status.HTTP_400_BAD_REQUEST), workers - 1)
+        self.assertEqual(PatientDoctorMapping.objects.count(), 1)
+
+
+class SoftDeleteTests(APITestCase):
+    """Test soft delete and the batched purge command"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='securepassword123')
+        refresh = RefreshToken.for_user(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
+        self.patient = Patient.objects.create(name='John Doe', age=45, gender='Male', created_by=self.user)
+        self.doctor = Doctor.objects.create(name='Dr. Jane Smith', specialty='Cardiology')
+        self.mapping = PatientDoctorMapping.objects.create(patient=self.patient, doctor=self.doctor)
+
+    def test_delete_patient_is_soft_and_cascades(self):
+        """Test that deleting a patient hides it and its mappings without removing rows"""
+        response = self.client.delete(reverse('patient-detail', args=[self.patient.id]))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        self.assertFalse(Patient.objects.filter(id=self.patient.id).exists())
+        self.assertFalse(PatientDoctorMapping.objects.exists())
+        self.assertTrue(Patient.all_objects.filter(id=self.patient.id, deleted_at__isnull=False).exists())
+        self.assertTrue(PatientDoctorMapping.all_objects.dead().filter(id=self.mapping.id).exists())
+        self.assertTrue(Doctor.objects.filter(id=self.doctor.id).exists())
+
+    def test_delete_owner_only_flags_their_rows(self):
+        """Test that deleting a user soft-deletes their patients and mappings"""
+        self.user.delete()
+
+        self.assertFalse(User.objects.filter(id=self.user.id).exists())
+        self.assertTrue(Patient.all_objects.dead().filter(id=self.patient.id).exists())
+        self.assertTrue(PatientDoctorMapping.all_objects.dead().filter(id=self.mapping.id).exists())
+
+        # The purge still clears them once the grace period is over
+        Patient.all_objects.update(deleted_at=timezone.now() - timedelta(days=30))
+        PatientDoctorMapping.all_objects.update(deleted_at=timezone.now() - timedelta(days=30))
+        call_command('purge_deleted', sleep=0, stdout=StringIO())
+        self.assertFalse(Patient.all_objects.exists())
+        self.assertFalse(PatientDoctorMapping.all_objects.exists())
+
+    def test_deleted_patient_cannot_be_mapped(self):
+        """Test that a soft-deleted patient is treated as missing"""
+        other_doctor = Doctor.objects.create(name='Dr. Michael Johnson', specialty='Neurology')
+        self.patient.delete()
+
+        response = self.client.post(reverse('mapping-list'), {
+            'patient': self.patient.id,
+            'doctor': other_doctor.id
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_removed_mapping_can_be_added_again(self):
+        """Test that re-assigning a removed doctor revives the soft-deleted mapping"""
+        self.mapping.delete()
+
+        response = self.client.post(reverse('mapping-list'), {
+            'patient': self.patient.id,
+            'doctor': self.doctor.id
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['id'], self.mapping.id)
+        self.assertEqual(PatientDoctorMapping.objects.count(), 1)
+
+    def test_purge_removes_old_deleted_rows_in_batches(self):
+        """Test that purge hard-deletes rows past the grace period only"""
+        recent = Patient.objects.create(name='Jane Smith', age=35, gender='Female', created_by=self.user)
+        self.patient.delete()
+        recent.delete()
+        old = timezone.now() - timedelta(days=30)
+        Patient.all_objects.filter(id=self.patient.id).update(deleted_at=old)
+        PatientDoctorMapping.all_objects.filter(id=self.mapping.id).update(deleted_at=old)
+
+        out = StringIO()
+        call_command('purge_deleted', batch_size=1, sleep=0, stdout=out)
+
+        self.assertFalse(Patient.all_objects.filter(id=self.patient.id).exists())
+        self.assertFalse(PatientDoctorMapping.all_objects.exists())
+        self.assertTrue(Patient.all_objects.filter(id=recent.id).exists())
+        self.assertIn('health.Patient: purged 1 rows', out.getvalue())
+
+    def test_purge_skips_gaps_between_dead_rows(self):
+        """Test that purging sparse dead ids only pauses after batches that deleted rows"""
+        old = timezone.now() - timedelta(days=30)
+        Patient.objects.bulk_create([
+            Patient(name=f'Live {n}', age=40, gender='Other', created_by=self.user) for n in range(20)
+        ])
+        dead = Patient.objects.create(name='Dead', age=40, gender='Other', created_by=self.user)
+        Patient.all_objects.filter(id__in=[self.patient.id, dead.id]).update(deleted_at=old)
+
+        with mock.patch('health.management.commands.purge_deleted.time.sleep') as sleep:
+            call_command('purge_deleted', batch_size=1, sleep=1, stdout=StringIO())
+
+        self.assertFalse(Patient.all_objects.filter(id__in=[self.patient.id, dead.id]).exists())
+        self.assertEqual(Patient.all_objects.count(), 20)
+        # One pause per batch that deleted something, none for the 20 live ids between
+        self.assertEqual(sleep.call_count, 2)
+
+
+class JobTests(APITestCase):
+    """Test the background job queue, worker and status endpoints"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='securepassword123')
+        refresh = RefreshToken.for_user(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
+        self.jobs_url = reverse('job-list')
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_export_job_runs_and_reports_result(self):
+        """Test that an enqueued export is picked up by the worker and exposes its result"""
+        patient = Patient.objects.create(name='John Doe', age=45, gender='Male', created_by=self.user)
+        doctor = Doctor.objects.create(name='Dr. Jane Smith', specialty='Cardiology')
+        PatientDoctorMapping.objects.create(patient=patient, doctor=doctor)
+
+        response = self.client.post(self.jobs_url, {'kind': 'export_patients'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], Job.QUEUED)
+
+        call_command('run_jobs', threads=1, burst=True, stdout=StringIO())
+
+        response = self.client.get(reverse('job-detail', args=[response.data['id']]))
+        self.assertEqual(response.data['status'], Job.SUCCEEDED)
+        self.assertEqual(response.data['progress'], 100)
+        exported = response.data['result']['patients']
+        self.assertEqual([p['name'] for p in exported], ['John Doe'])
+        self.assertEqual(exported[0]['doctors'][0]['name'], 'Dr. Jane Smith')
+
+        # The list leaves results to the detail endpoint
+        response = self.client.get(self.jobs_url)
+        self.assertNotIn('result', response.data['results'][0])
+
+    def test_failed_job_records_error(self):
+        """Test that a handler exception marks the job failed"""
+        register_job('test_explode')(lambda job: 1 / 0)
+        self.addCleanup(job_registry.pop, 'test_explode')
+        job = enqueue('test_explode', user=self.user)
+
+        call_command('run_jobs', threads=1, burst=True, stdout=StringIO())
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertIn('ZeroDivisionError', job.error)
+
+    def test_job_is_claimed_once(self):
+        """Test that a claimed job is not handed to a second worker"""
+        job = enqueue('export_patients', user=self.user)
+        self.assertEqual(claim_next('worker-a').id, job.id)
+        self.assertIsNone(claim_next('worker-b'))
+
+    def test_job_of_dead_worker_is_reclaimed(self):
+        """Test that a running job whose lease lapsed is retried, then failed after the last attempt"""
+        job = enqueue('export_patients', user=self.user)
+        expired = timezone.now() - timedelta(seconds=1)
+        with self.settings(HEALTH_JOB_MAX_ATTEMPTS=2):
+            self.assertEqual(claim_next('worker-a').id, job.id)
+            # worker-a crashes without finishing or renewing its lease
+            Job.objects.filter(id=job.id).update(lease_expires_at=expired)
+            reclaimed = claim_next('worker-b')
+            self.assertEqual((reclaimed.id, reclaimed.worker, reclaimed.attempts), (job.id, 'worker-b', 2))
+
+            Job.objects.filter(id=job.id).update(lease_expires_at=expired)
+            self.assertIsNone(claim_next('worker-c'))
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertIn('Worker stopped', job.error)
+
+    def test_staff_only_and_unknown_kinds_rejected(self):
+        """Test that users cannot start staff-only or unregistered jobs"""
+        response = self.client.post(self.jobs_url, {'kind': 'purge_deleted'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(self.jobs_url, {'kind': 'no_such_job'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_users_only_see_own_jobs(self):
+        """Test that job status is private to the user who started it"""
+        other = User.objects.create_user(username='other', password='securepassword123')
+        job = enqueue('export_patients', user=other)
+        response = self.client.get(reverse('job-detail', args=[job.id]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class AdminScalingTests(TestCase):
+    """Test that admin changelists cost a constant number of queries"""
+
+    def setUp(self):
+        self.admin_user = User.objects.create_superuser(username='admin', password='securepassword123')
+        self.client.force_login(self.admin_user)
+
+    def add_rows(self, count):
+        for _ in range(count):
+            owner = User.objects.create_user(username=f'owner{User.objects.count()}')
+            patient = Patient.objects.create(name='John Doe', age=45, gender='Male', created_by=owner)
+            doctor = Doctor.objects.create(name='Dr. Jane Smith', specialty='Cardiology')
+            PatientDoctorMapping.objects.create(patient=patient, doctor=doctor)
+
+    def changelist_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_changelists_do_not_grow_with_rows(self):
+        """Test that more rows (and owners/doctors) do not add queries"""
+        urls = [
+            reverse('admin:health_patient_changelist'),
+            reverse('admin:health_doctor_changelist'),
+            reverse('admin:health_patientdoctormapping_changelist'),
+        ]
+        self.add_rows(2)
+        before = [self.changelist_queries(url) for url in urls]
+        self.add_rows(15)
+        after = [self.changelist_queries(url) for url in urls]
+        self.assertEqual(before, after)
+
+    def test_input_filters(self):
+        """Test that search-driven sidebar filters narrow the changelist"""
+        self.add_rows(2)
+        mapping = PatientDoctorMapping.objects.first()
+        response = self.client.get(reverse('admin:health_patientdoctormapping_changelist'),
+                                   {'doctor_id': mapping.doctor_id})
+        self.assertEqual(response.context['cl'].result_count, 1)
+
+        response = self.client.get(reverse('admin:health_patient_changelist'),
+                                   {'owner': mapping.patient.created_by.username})
+        self.assertEqual(response.context['cl'].result_count, 1)
+        self.assertContains(response, 'name="owner"')
+
+        Job.objects.create(kind='export_patients')
+        Job.objects.create(kind='purge_deleted')
+        response = self.client.get(reverse('admin:health_job_changelist'), {'kind': 'purge_deleted'})
+        self.assertEqual(response.context['cl'].result_count, 1)
+        self.assertContains(response, 'name="kind"')
+
+    def test_estimated_count_above_threshold(self):
+        """Test that a large planner estimate replaces the exact COUNT(*)"""
+        fake = mock.MagicMock(vendor='postgresql')
+        cursor = fake.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = [[{'Plan': {'Plan Rows': 5000000}}]]
+        with mock.patch('health.admin.connection', fake), self.assertNumQueries(0):
+            paginator = EstimatedCountPaginator(Patient.objects.all(), 100)
+            self.assertEqual(paginator.count, 5000000)
+
+
+class StartupTests(TestCase):
+    """Test worker prewarming and the startup profiler's parsing"""
+
+    def test_prewarm_reports_each_step(self):
+        """Test that prewarm warms URLs and serializers"""
+        timings = prewarm()
+        self.assertEqual(set(timings), {'urls', 'serializers'})
+
+    @override_settings(HEALTH_PREWARM=False)
+    def test_prewarm_can_be_disabled(self):
+        """Test that prewarm is skipped when HEALTH_PREWARM is off"""
+        self.assertIsNone(prewarm_if_enabled())
+
+    def test_parse_importtime(self):
+        """Test parsing of python -X importtime output"""
+        stderr = (
+            "import time: self [us] | cumulative | imported package\n"
+            "import time:       297 |       1708 |     django.utils.regex_helper\n"
+            "import time:       295 |      23228 | django\n"
+        )
+        self.assertEqual(parse_importtime(stderr), [
+            ('django.utils.regex_helper', 297, 1708, 2),
+            ('django', 295, 23228, 0),
+        ])
+
+
+
+@override_settings(HEALTH_COMPRESSION_MIN_SIZE=200)
+class PayloadTrimmingTests(APITestCase):
+    """Test response compression and sparse fieldsets"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='securepassword123')
+        refresh = RefreshToken.for_user(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
+        for i in range(10):
+            Patient.objects.create(name=f'Patient number {i}', age=40 + i, gender='Other', created_by=self.user)
+        self.patients_url = reverse('patient-list')
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_large_list_is_gzipped(self):
+        """Test that a list above the size threshold is gzip encoded"""
+        response = self.client.get(self.patients_url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        body = json.loads(gzip.decompress(response.content))
+        self.assertEqual(body['count'], 10)
+
+    @override_settings(HEALTH_COMPRESSION_MIN_SIZE=100000)
+    def test_small_response_not_compressed(self):
+        """Test that responses under the threshold are sent as-is"""
+        response = self.client.get(self.patients_url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    @skipIf(brotli is None, "brotli is not installed")
+    def test_brotli_preferred(self):
+        """Test that brotli wins when the client accepts both"""
+        response = self.client.get(self.patients_url, HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(json.loads(brotli.decompress(response.content))['count'], 10)
+
+    def test_sparse_fieldset_narrows_output_and_select(self):
+        """Test that ?fields= trims both the JSON and the SQL columns"""
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.patients_url, {'fields': 'id,name'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data['results'][0]), {'id', 'name'})
+        select = [q['sql'] for q in context.captured_queries if 'FROM "health_patient"' in q['sql'] and 'COUNT' not in q['sql']]
+        self.assertEqual(len(select), 1)
+        self.assertNotIn('"health_patient"."age"', select[0])
+
+    def test_sparse_fieldset_rejects_unknown_fields(self):
+        """Test that unknown field names are a 400"""
+        response = self.client.get(self.patients_url, {'fields': 'id,ssn'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_sparse_fieldset_on_patient_doctors(self):
+        """Test that ?fields= also applies to a patient's doctor list"""
+        patient = Patient.objects.filter(created_by=self.user).first()
+        doctor = Doctor.objects.create(name='Dr. Jane Smith', specialty='Cardiology')
+        PatientDoctorMapping.objects.create(patient=patient, doctor=doctor)
+
+        response = self.client.get(reverse('get_doctors_for_patient', args=[patient.id]), {'fields': 'name'})
+        self.assertEqual(response.data, [{'name': 'Dr. Jane Smith'}])
+
+
+class PatientExpandTests(APITestCase):
+    """Test embedding a patient's doctors with ?expand=doctors"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='securepassword123')
+        refresh = RefreshToken.for_user(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
+        self.patients_url = reverse('patient-list')
+
+    def tearDown(self):
+        cache.clear()
+
+    def add_patients(self, count, doctors_each=2):
+        for i in range(count):
+            patient = Patient.objects.create(name=f'Patient {i}', age=40, gender='Other', created_by=self.user)
+            for j in range(doctors_each):
+                doctor = Doctor.objects.create(name=f'Dr. {i}-{j}', specialty='Cardiology')
+                PatientDoctorMapping.objects.create(patient=patient, doctor=doctor)
+
+    def list_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.patients_url, {'expand': 'doctors'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, len(context.captured_queries)
+
+    def test_expand_embeds_doctors(self):
+        """Test that each patient carries its doctors"""
+        self.add_patients(1)
+        response, _ = self.list_queries()
+        doctors = response.data['results'][0]['doctors']
+        self.assertEqual([d['name'] for d in doctors], ['Dr. 0-0', 'Dr. 0-1'])
+
+    def test_expand_query_count_is_constant(self):
+        """Test that a full page of patients with doctors costs a fixed number of queries"""
+        self.add_patients(2)
+        _, small = self.list_queries()
+        self.add_patients(20, doctors_each=3)
+        response, large = self.list_queries()
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertEqual(small, large)
+        # user lookup, page count, patients, mappings joined to doctors
+        self.assertEqual(large, 4)
+
+    def test_expand_with_sparse_fields(self):
+        """Test that an expanded field can be picked with ?fields= and is left out otherwise"""
+        self.add_patients(1)
+        response = self.client.get(self.patients_url, {'expand': 'doctors', 'fields': 'id,doctors'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        patient = response.data['results'][0]
+        self.assertEqual(set(patient), {'id', 'doctors'})
+        self.assertEqual([d['name'] for d in patient['doctors']], ['Dr. 0-0', 'Dr. 0-1'])
+
+        response = self.client.get(self.patients_url, {'expand': 'doctors', 'fields': 'id'})
+        self.assertEqual(set(response.data['results'][0]), {'id'})
+
+        response = self.client.get(self.patients_url, {'fields': 'id,doctors'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_expand_on_retrieve(self):
+        """Test that ?expand=doctors works on the detail endpoint"""
+        self.add_patients(1)
+        patient = Patient.objects.get()
+        response = self.client.get(reverse('patient-detail', args=[patient.id]), {'expand': 'doctors'})
+        self.assertEqual(len(response.data['doctors']), 2)
+
+    def test_without_expand_no_doctors(self):
+        """Test that doctors are only embedded on request"""
+        self.add_patients(1)
+        response = self.client.get(self.patients_url)
+        self.assertNotIn('doctors', response.data['results'][0])
+
+    def test_unknown_expansion_rejected(self):
+        """Test that unsupported expansions are a 400"""
+        response = self.client.get(self.patients_url, {'expand': 'appointments'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+
+@override_settings(HEALTH_BATCH_CONCURRENT_READS=False)
+class BatchTests(APITestCase):
+    """Test the batch endpoint that runs several API calls in one request"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='securepassword123')
+        refresh = RefreshToken.for_user(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
+        self.patient = Patient.objects.create(name='John Doe', age=45, gender='Male', created_by=self.user)
+        self.doctor = Doctor.objects.create(name='Dr. Jane Smith', specialty='Cardiology')
+        self.batch_url = reverse('batch')
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_batch_runs_requests_in_order(self):
+        """Test that sub-responses come back in request order"""
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(self.batch_url, {'requests': [
+                {'method': 'GET', 'path': '/api/patients/'},
+                {'method': 'GET', 'path': '/api/doctors/?fields=name'},
+                {'method': 'POST', 'path': '/api/mappings/',
+                 'body': {'patient': self.patient.id, 'doctor': self.doctor.id}},
+                {'method': 'GET', 'path': f'/api/mappings/{self.patient.id}/'},
+            ]}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.json()['responses']
+        self.assertEqual([r['status'] for r in results], [200, 200, 201, 200])
+        self.assertEqual(results[0]['body']['results'][0]['name'], 'John Doe')
+        self.assertEqual(results[1]['body']['results'], [{'name': 'Dr. Jane Smith'}])
+        self.assertEqual(results[3]['body'][0]['name'], 'Dr. Jane Smith')
+        # The user is loaded once for the whole batch
+        user_lookups = [q for q in context.captured_queries if 'FROM "auth_user"' in q['sql']]
+        self.assertEqual(len(user_lookups), 1)
+
+    def test_atomic_batch_rolls_back_on_failure(self):
+        """Test that a failing sub-request undoes earlier writes in an atomic batch"""
+        response = self.client.post(self.batch_url, {'atomic': True, 'requests': [
+            {'method': 'POST', 'path': '/api/patients/', 'body': {'name': 'Alice', 'age': 30, 'gender': 'Female'}},
+            {'method': 'POST', 'path': '/api/mappings/', 'body': {'patient': self.patient.id, 'doctor': 999}},
+        ]}, format='json')
+
+        body = response.json()
+        self.assertFalse(body['committed'])
+        self.assertEqual([r['status'] for r in body['responses']], [201, 400])
+        self.assertFalse(Patient.objects.filter(name='Alice').exists())
+
+    def test_atomic_batch_commits(self):
+        """Test that an all-successful atomic batch is committed"""
+        response = self.client.post(self.batch_url, {'atomic': True, 'requests': [
+            {'method': 'POST', 'path': '/api/patients/', 'body': {'name': 'Alice', 'age': 30, 'gender': 'Female'}},
+        ]}, format='json')
+        self.assertTrue(response.json()['committed'])
+        self.assertTrue(Patient.objects.filter(name='Alice', created_by=self.user).exists())
+
+    def test_batch_requires_authentication(self):
+        """Test that the batch itself must be authenticated"""
+        self.client.credentials()
+        response = self.client.post(self.batch_url, {'requests': [{'path': '/api/patients/'}]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_batch_rejects_bad_requests(self):
+        """Test validation of the batch payload"""
+        for payload in [
+            {'requests': []},
+            {'requests': [{'path': '/admin/'}]},
+            {'requests': [{'path': '/api/batch/'}]},
+            {'requests': [{'method': 'TRACE', 'path': '/api/patients/'}]},
+            {'requests': [{'path': '/api/patients/'}] * 21},
+        ]:
+            response = self.client.post(self.batch_url, payload, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, payload)
+
+    def test_sub_request_isolation(self):
+        """Test that sub-requests still enforce per-user ownership"""
+        other = User.objects.create_user(username='other', password='securepassword123')
+        other_patient = Patient.objects.create(name='Jane Smith', age=35, gender='Female', created_by=other)
+        response = self.client.post(self.batch_url, {'requests': [
+            {'path': f'/api/patients/{other_patient.id}/'},
+        ]}, format='json')
+        self.assertEqual(response.json()['responses'][0]['status'], 404)
+
+    def test_stream_is_not_batchable(self):
+        """Test that the async change stream is refused per item rather than failing the batch"""
+        response = self.client.post(self.batch_url, {'requests': [
+            {'path': '/api/stream/'},
+            {'path': '/api/patients/'},
+        ]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([r['status'] for r in response.json()['responses']], [400, 200])
+
+    def test_reads_are_sequential_under_wsgi(self):
+        """Test that a WSGI worker does not fan reads out to extra threads"""
+        with mock.patch('health.batch._dispatch_in_thread') as dispatch_in_thread:
+            response = self.client.post(self.batch_url, {'requests': [
+                {'path': '/api/patients/'},
+                {'path': '/api/doctors/'},
+            ]}, format='json')
+        self.assertEqual([r['status'] for r in response.json()['responses']], [200, 200])
+        dispatch_in_thread.assert_not_called()
+
+
+class ConcurrentBatchTests(TransactionTestCase):
+    """Test that runs of reads in a batch are dispatched concurrently under ASGI"""
+
+    async def test_concurrent_reads(self):
+        """Test that concurrent reads return the same data as sequential ones"""
+        cache.clear()
+        user = await User.objects.acreate(username='testuser')
+        await Patient.objects.acreate(name='John Doe', age=45, gender='Male', created_by=user)
+        await Doctor.objects.acreate(name='Dr. Jane Smith', specialty='Cardiology')
+        token = await sync_to_async(lambda: str(RefreshToken.for_user(user).access_token))()
+
+        with mock.patch('health.batch._dispatch_in_thread', wraps=_dispatch_in_thread) as dispatch_in_thread:
+            response = await AsyncClient().post(reverse('batch'), {'requests': [
+                {'path': '/api/patients/'},
+                {'path': '/api/doctors/'},
+                {'path': '/api/patients/'},
+            ]}, content_type='application/json', headers={'Authorization': f'Bearer {token}'})
+
+        self.assertEqual(dispatch_in_thread.call_count, 3)
+        results = response.json()['responses']
+        self.assertEqual([r['status'] for r in results], [200, 200, 200])
+        self.assertEqual(results[1]['body']['results'][0]['name'], 'Dr. Jane Smith')
+        self.assertEqual(results[0], results[2])
+
+
+class TenantPartitioningTests(APITestCase):
+    """Test the owner tenant key on mappings"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='securepassword123')
+        self.other = User.objects.create_user(username='other', password='securepassword123')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+        self.patient = Patient.objects.create(name='John Doe', age=45, gender='Male', created_by=self.user)
+        self.other_patient = Patient.objects.create(name='Jane Smith', age=35, gender='Female', created_by=self.other)
+        self.doctor = Doctor.objects.create(name='Dr. Jane Smith', specialty='Cardiology')
+
+    def test_owner_copied_from_patient(self):
+        """Test that mappings created through the ORM and the API carry the patient's owner"""
+        orm = PatientDoctorMapping.objects.create(patient=self.other_patient, doctor=self.doctor)
+        self.assertEqual(orm.owner_id, self.other.id)
+
+        response = self.client.post(reverse('mapping-list'), {
+            'patient': self.patient.id, 'doctor': self.doctor.id
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn('owner', response.data)
+        self.assertEqual(PatientDoctorMapping.objects.get(id=response.data['id']).owner, self.user)
+
+    def test_mapping_list_is_scoped_to_owner(self):
+        """Test that users only list mappings of their own patients"""
+        mine = PatientDoctorMapping.objects.create(patient=self.patient, doctor=self.doctor)
+        PatientDoctorMapping.objects.create(patient=self.other_patient, doctor=self.doctor)
+
+        response = self.client.get(reverse('mapping-list'))
+        self.assertEqual([m['id'] for m in response.data['results']], [mine.id])
+
+    def test_patient_owner_cannot_change(self):
+        """Test that a saved patient can't be handed to another owner, leaving mappings behind"""
+        PatientDoctorMapping.objects.create(patient=self.patient, doctor=self.doctor)
+        patient = Patient.objects.get(id=self.patient.id)
+        patient.created_by = self.other
+        with self.assertRaises(ValueError):
+            patient.save()
+
+        patient.created_by = self.user
+        patient.name = 'John Roe'
+        patient.save()
+        self.assertEqual(PatientDoctorMapping.objects.get().owner, self.user)
+
+        admin_user = User.objects.create_superuser(username='admin', password='securepassword123')
+        self.client.force_login(admin_user)
+        response = self.client.get(reverse('admin:health_patient_change', args=[patient.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('name="created_by"', response.content.decode())
+
+    @skipIf(connection.vendor == 'postgresql', "Partitioning is available here")
+    def test_command_requires_postgresql(self):
+        """Test that the partition tooling refuses to run on other databases"""
+        with self.assertRaises(CommandError):
+            call_command('tenant_partitions', 'status', stdout=StringIO())
+
+
+@skipIf(connection.vendor != 'postgresql', "Declarative partitioning needs PostgreSQL")
+class PostgresPartitionTests(TestCase):
+    """Test partition pruning and splitting on PostgreSQL"""
+
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f'user{i}', password='x') for i in range(4)]
+        doctor = Doctor.objects.create(name='Dr. Jane Smith', specialty='Cardiology')
+        for user in self.users:
+            patient = Patient.objects.create(name='John Doe', age=45, gender='Male', created_by=user)
+            PatientDoctorMapping.objects.create(patient=patient, doctor=doctor)
+
+    def test_api_queries_are_pruned(self):
+        """Test that every tenant-scoped query plans against a single partition"""
+        for label, scanned in pruning_report(self.users[0]).items():
+            self.assertEqual(len(scanned), 1, label)
+
+    def test_split_keeps_rows(self):
+        """Test that splitting a partition doubles its modulus without losing rows"""
+        with connection.cursor() as cursor:
+            name, modulus, _, _ = partitions(cursor, 'health_patient')[0]
+        call_command('tenant_partitions', 'split', table='health_patient', partition=name, stdout=StringIO())
+
+        with connection.cursor() as cursor:
+            moduli = [row[1] for row in partitions(cursor, 'health_patient')]
+        self.assertEqual(moduli.count(modulus * 2), 2)
+        self.assertEqual(Patient.objects.count(), 4)
+        for user in self.users:
+            self.assertEqual(Patient.objects.filter(created_by=user).count(), 1)
+
+    def test_split_referenced_partition(self):
+        """Test splitting the patient partition that existing mappings point into"""
+        patient = Patient.objects.get(created_by=self.users[0])
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT tableoid::regclass::text FROM health_patient WHERE id = %s", [patient.id])
+            name = cursor.fetchone()[0]
+        call_command('tenant_partitions', 'split', table='health_patient', partition=name, stdout=StringIO())
+
+        self.assertEqual(PatientDoctorMapping.objects.filter(patient=patient).count(), 1)
+        with connection.cursor() as cursor:
+            self.assertEqual(len(referencing_foreign_keys(cursor, 'health_patient')), 1)
+            # The composite key is enforced again after the split
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                PatientDoctorMapping.objects.filter(patient=patient).update(owner=self.users[1])
+                cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+
+
+class ChangeStreamTests(APITestCase):
+    """Test the server-sent change stream"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='securepassword123')
+        self.other = User.objects.create_user(username='other', password='securepassword123')
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+        self.patient = Patient.objects.create(name='John Doe', age=45, gender='Male', created_by=self.user)
+        self.doctor = Doctor.objects.create(name='Dr. Jane Smith', specialty='Cardiology')
+
+    def subscribe(self, user):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        async def subscribe():
+            return broker.subscribe(user.pk)
+        queue = loop.run_until_complete(subscribe())
+        self.addCleanup(broker.unsubscribe, user.pk, queue)
+        return loop, queue
+
+    def received(self, loop, queue):
+        loop.run_until_complete(asyncio.sleep(0))
+        events = []
+        while not queue.empty():
+            events.append(queue.get_nowait())
+        return [(event['type'], event.get('id')) for event in events]
+
+    def test_events_reach_owner_only(self):
+        """Test that saves are published on commit to the owner's streams only"""
+        loop, queue = self.subscribe(self.user)
+        other_loop, other_queue = self.subscribe(self.other)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.patient.name = 'John Q. Doe'
+            self.patient.save()
+            self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.token}')
+            response = self.client.post(reverse('mapping-list'), {
+                'patient': self.patient.id, 'doctor': self.doctor.id
+            }, format='json')
+
+        self.assertEqual(self.received(loop, queue), [
+            ('patient.updated', self.patient.id), ('mapping.created', response.data['id']),
+        ])
+        self.assertEqual(self.received(other_loop, other_queue), [])
+
+    def test_soft_delete_publishes_cascade(self):
+        """Test that deleting a patient announces its mappings' removal too"""
+        mapping = PatientDoctorMapping.objects.create(patient=self.patient, doctor=self.doctor)
+        loop, queue = self.subscribe(self.user)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.patient.delete()
+
+        self.assertEqual(self.received(loop, queue), [
+            ('mapping.deleted', mapping.id), ('patient.deleted', self.patient.id),
+        ])
+
+    def test_slow_client_is_told_to_resync(self):
+        """Test that an overflowing stream queue is replaced by a resync event"""
+        loop, queue = self.subscribe(self.user)
+        with override_settings(HEALTH_EVENTS_QUEUE_SIZE=2):
+            loop2, small = self.subscribe(self.user)
+        for i in range(3):
+            broker.deliver(self.user.pk, {'type': 'patient.updated', 'id': i})
+        self.assertEqual(self.received(loop2, small), [('resync', None)])
+        self.assertEqual(len(self.received(loop, queue)), 3)
+
+    async def test_stream_sends_events(self):
+        """Test that an open stream receives events and unsubscribes when it ends"""
+        with self.settings(HEALTH_EVENTS_MAX_AGE=1):
+            response = await self.async_client.get(
+                reverse('stream'), headers={'Authorization': f'Bearer {self.token}'}
+            )
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        chunks = aiter(response.streaming_content)
+        self.assertIn(b'event: ready', await anext(chunks))
+
+        def create():
+            with self.captureOnCommitCallbacks(execute=True):
+                Patient.objects.create(name='Jane Roe', age=30, gender='Female', created_by=self.user)
+        await sync_to_async(create)()
+
+        chunk = await asyncio.wait_for(anext(chunks), timeout=1)
+        self.assertTrue(chunk.startswith(b'event: patient.created\n'))
+        self.assertEqual(json.loads(chunk.split(b'data: ')[1])['data']['name'], 'Jane Roe')
+        rest = [chunk async for chunk in chunks]
+        self.assertEqual(set(rest), {b': keep-alive\n\n'})
+        self.assertFalse(broker.has_subscribers())
+
+    async def test_open_streams_are_capped_per_user(self):
+        """Test that a user past the open stream limit gets a 429"""
+        with self.settings(HEALTH_EVENTS_MAX_STREAMS_PER_USER=1):
+            queue = broker.subscribe(self.user.pk)
+            try:
+                response = await self.async_client.get(
+                    reverse('stream'), headers={'Authorization': f'Bearer {self.token}'}
+                )
+            finally:
+                broker.unsubscribe(self.user.pk, queue)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn('Retry-After', response)
+        self.assertFalse(broker.has_subscribers())
+
+    async def test_stream_requires_token(self):
+        """Test that the stream rejects unauthenticated requests"""
+        response = await self.async_client.get(reverse('stream'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = await self.async_client.get(reverse('stream'), {'ticket': 'bad'})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        # Access tokens are not accepted in the query string
+        response = await self.async_client.get(reverse('stream'), {'token': self.token})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    async def test_stream_ticket_is_single_use(self):
+        """Test that a stream ticket opens one stream and is then spent"""
+        response = await self.async_client.post(
+            reverse('stream-ticket'), headers={'Authorization': f'Bearer {self.token}'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        ticket = response.json()['ticket']
+
+        with self.settings(HEALTH_EVENTS_MAX_AGE=0):
+            response = await self.async_client.get(reverse('stream'), {'ticket': ticket})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            [chunk async for chunk in response.streaming_content]
+            response = await self.async_client.get(reverse('stream'), {'ticket': ticket})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_stream_needs_asgi(self):
+        """Test that the stream refuses to run under WSGI"""
+        response = self.client.get(reverse('stream'), HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        self.assertEqual(response.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+
+
+class TokenRevocationTests(APITestCase):
+    """Test logout and the bloom-filtered revocation check"""
+
+    def setUp(self):
+        cache.clear()
+        revocations.reset()
+        self.user = User.objects.create_user(username='testuser', password='securepassword123')
+        self.refresh = RefreshToken.for_user(self.user)
+        self.access = self.refresh.access_token
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access}')
+        self.patients_url = reverse('patient-list')
+
+    def tearDown(self):
+        revocations.reset()
+        cache.clear()
+
+    def test_bloom_filter(self):
+        """Test that the filter never misses a member and rarely reports a stranger"""
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(f'jti-{i}')
+        self.assertTrue(all(f'jti-{i}' in bloom for i in range(1000)))
+        false_positives = sum(f'other-{i}' in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_logout_revokes_access_and_refresh(self):
+        """Test that logged-out tokens can no longer authenticate or refresh"""
+        self.assertEqual(self.client.get(self.patients_url).status_code, status.HTTP_200_OK)
+
+        response = self.client.post(reverse('logout'), {'refresh': str(self.refresh)}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(RevokedToken.objects.filter(user=self.user).count(), 2)
+
+        response = self.client.get(self.patients_url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.client.credentials()
+        response = self.client.post(reverse('token_refresh'), {'refresh': str(self.refresh)}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_cannot_revoke_another_users_token(self):
+        """Test that a refresh token of another user is refused"""
+        other = User.objects.create_user(username='other', password='securepassword123')
+        response = self.client.post(reverse('logout'), {
+            'refresh': str(RefreshToken.for_user(other))
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(RevokedToken.objects.exists())
+
+    @override_settings(HEALTH_REVOCATION_REFRESH=0)
+    def test_revocations_by_other_workers_are_picked_up(self):
+        """Test that rows written elsewhere reach this worker's filter on refresh"""
+        self.assertEqual(self.client.get(self.patients_url).status_code, status.HTTP_200_OK)
+        RevokedToken.objects.create(jti=self.access['jti'], user=self.user,
+                                    expires_at=timezone.now() + timedelta(hours=1))
+        self.assertEqual(self.client.get(self.patients_url).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(HEALTH_REVOCATION_REFRESH=0)
+    def test_late_commits_with_lower_ids_are_picked_up(self):
+        """Test that a revocation committed after a higher id was fetched is still seen"""
+        expires_at = timezone.now() + timedelta(hours=1)
+        RevokedToken.objects.create(id=100, jti='committed-first', expires_at=expires_at)
+        self.assertTrue(revocations.is_revoked('committed-first'))
+
+        RevokedToken.objects.create(id=50, jti=self.access['jti'], user=self.user, expires_at=expires_at)
+        self.assertEqual(self.client.get(self.patients_url).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_check_skips_database_unless_probable_hit(self):
+        """Test that only filter hits are confirmed against the table"""
+        revocations.is_revoked('warm-up')
+        with CaptureQueriesContext(connection) as context:
+            self.assertFalse(revocations.is_revoked('not-revoked'))
+        self.assertEqual(len(context.captured_queries), 0)
+
+        # A false positive: in the filter but not in the table
+        revocations.add('false-positive')
+        with CaptureQueriesContext(connection) as context:
+            self.assertFalse(revocations.is_revoked('false-positive'))
+        self.assertEqual(len(context.captured_queries), 1)
+
+
+class QueryBudgetTests(APITestCase):
+    """Test that every API endpoint stays within its query budget"""
+
+    # Queries per call, including the JWT user lookup. Every list has several
+    # rows behind it, so a query per row would blow the budget.
+    BUDGETS = {
+        ('register', 'post'): 3,
+        ('patient-list', 'get'): 3,
+        ('patient-list', 'post'): 2,
+        ('patient-detail', 'get'): 2,
+        ('patient-detail', 'put'): 3,
+        ('patient-detail', 'delete'): 4,
+        ('doctor-list', 'get'): 3,
+        ('doctor-list', 'post'): 2,
+        ('doctor-detail', 'get'): 2,
+        ('doctor-detail', 'put'): 3,
+        ('doctor-detail', 'delete'): 4,
+        ('mapping-list', 'get'): 3,
+        ('mapping-list', 'post'): 2,
+        ('get_doctors_for_patient', 'get'): 3,
+        ('job-list', 'get'): 3,
+        ('job-list', 'post'): 2,
+        ('job-detail', 'get'): 2,
+        ('stream-ticket', 'post'): 1,
+        ('token_obtain_pair', 'post'): 1,
+        ('token_refresh', 'post'): 1,
+        # One user lookup for the whole batch, then two queries per sub-request
+        ('batch', 'post'): 5,
+        # Last: revokes the token the other calls use
+        ('logout', 'post'): 3,
+    }
+
+    def setUp(self):
+        cache.clear()
+        revocations.reset()
+        self.user = User.objects.create_user(username='testuser', password='securepassword123')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+        self.doctors = [Doctor.objects.create(name=f'Dr. {i}', specialty='Cardiology') for i in range(5)]
+        self.patients = [
+            Patient.objects.create(name=f'Patient {i}', age=40 + i, gender='Other', created_by=self.user)
+            for i in range(4)
+        ]
+        for patient in self.patients:
+            for doctor in self.doctors[:3]:
+                PatientDoctorMapping.objects.create(patient=patient, doctor=doctor)
+        self.job = enqueue('export_patients', user=self.user)
+        enqueue('export_patients', user=self.user)
+        # Load the revocation filter now rather than inside the first budget
+        revocations.is_revoked('warm-up')
+
+    def tearDown(self):
+        revocations.reset()
+        cache.clear()
+
+    def call(self, name, method):
+        args, data = [], None
+        if name in ('patient-detail', 'get_doctors_for_patient'):
+            args = [self.patients[-1 if method == 'delete' else 0].id]
+        elif name == 'doctor-detail':
+            args = [self.doctors[-1 if method == 'delete' else 0].id]
+        elif name == 'job-detail':
+            args = [self.job.id]
+
+        if name == 'register':
+            data = {'username': 'newuser', 'email': 'new@example.com', 'password': 'securepassword123'}
+        elif name.startswith('patient') and method in ('post', 'put'):
+            data = {'name': 'Jane Roe', 'age': 30, 'gender': 'Female'}
+        elif name.startswith('doctor') and method in ('post', 'put'):
+            data = {'name': 'Dr. Roe', 'specialty': 'Neurology'}
+        elif name == 'mapping-list' and method == 'post':
+            data = {'patient': self.patients[0].id, 'doctor': self.doctors[3].id}
+        elif name == 'job-list' and method == 'post':
+            data = {'kind': 'export_patients'}
+        elif name == 'token_obtain_pair':
+            data = {'username': 'testuser', 'password': 'securepassword123'}
+        elif name == 'token_refresh':
+            data = {'refresh': str(RefreshToken.for_user(self.user))}
+        elif name == 'batch':
+            data = {'requests': [{'path': '/api/patients/'}, {'path': f'/api/mappings/{self.patients[0].id}/'}]}
+        return getattr(self.client, method)(reverse(name, args=args), data, format='json')
+
+    def test_endpoints_within_budget(self):
+        """Test each endpoint's query count against its budget"""
+        for (name, method), budget in self.BUDGETS.items():
+            with self.subTest(endpoint=name, method=method):
+                with query_budget(budget):
+                    response = self.call(name, method)
+                self.assertLess(response.status_code, 400, response.content)
+
+    def test_expanded_patient_list_within_budget(self):
+        """Test that embedding doctors costs one query for the whole page"""
+        with query_budget(4):
+            response = self.client.get(reverse('patient-list'), {'expand': 'doctors'})
+        self.assertEqual(len(response.data['results'][0]['doctors']), 3)
+
+    def test_stream_within_budget(self):
+        """Test that opening the change stream costs only the user lookup"""
+        async def drain(response):
+            return [chunk async for chunk in response.streaming_content]
+
+        token = str(RefreshToken.for_user(self.user).access_token)
+        # A stream that ends right after its ready event
+        with self.settings(HEALTH_EVENTS_MAX_AGE=0), query_budget(1):
+            response = async_to_sync(AsyncClient().get)(
+                reverse('stream'), headers={'Authorization': f'Bearer {token}'}
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(len(async_to_sync(drain)(response)), 1)
+        self.assertFalse(broker.has_subscribers())
+
+    def test_every_viewset_has_a_budget(self):
+        """Test that a newly registered viewset can't skip declaring budgets"""
+        budgeted = {name.rsplit('-', 1)[0] for name, _ in self.BUDGETS}
+        for _, _, basename in router.registry:
+            self.assertIn(basename, budgeted)
+
+    def test_budget_failure_reports_repeats(self):
+        """Test that an exceeded budget lists the repeated statement"""
+        with self.assertRaises(AssertionError) as raised:
+            with query_budget(2):
+                for patient in Patient.objects.order_by('id'):
+                    patient.created_by.username
+        self.assertIn('repeated 4x', str(raised.exception))
+
+
+def _per_row_view(request):
+    # An N+1 on purpose: one user query per patient
+    names = [patient.created_by.username for patient in Patient.objects.all()]
+    return HttpResponse(len(names))
+
+
+class NPlusOneMiddlewareTests(TestCase):
+    """Test the development N+1 detector"""
+
+    def setUp(self):
+        user = User.objects.create_user(username='testuser', password='securepassword123')
+        for i in range(5):
+            Patient.objects.create(name=f'Patient {i}', age=40, gender='Other', created_by=user)
+        self.request = RequestFactory().get('/api/patients/')
+
+    def middleware(self, view):
+        def get_response(request):
+            middleware.process_view(request, view, (), {})
+            return view(request)
+        middleware = NPlusOneMiddleware(get_response)
+        return middleware
+
+    def test_shape_ignores_values(self):
+        """Test that statements differing only in parameters share a shape"""
+        self.assertEqual(
+            sql_shape("SELECT * FROM t WHERE id = 1 AND name = 'a'"),
+            sql_shape("SELECT * FROM t WHERE id = 22 AND name = 'it''s'"),
+        )
+        self.assertEqual(sql_shape("WHERE id IN (1, 2, 3)"), sql_shape("WHERE id IN (4)"))
+
+    @override_settings(HEALTH_NPLUSONE_DETECTION=True)
+    def test_repeated_queries_are_logged_with_call_site(self):
+        """Test that a per-row query is reported with the line that issued it"""
+        with self.assertLogs('health.middleware', 'WARNING') as logs:
+            self.middleware(_per_row_view)(self.request)
+        self.assertIn('5 x SELECT', logs.output[0])
+        self.assertIn('in _per_row_view', logs.output[0])
+
+    @override_settings(HEALTH_NPLUSONE_DETECTION=True)
+    def test_exempt_views_are_not_reported(self):
+        """Test that views marked nplusone_exempt are skipped"""
+        def view(request):
+            return _per_row_view(request)
+        view.nplusone_exempt = True
+        with self.assertNoLogs('health.middleware', 'WARNING'):
+            self.middleware(view)(self.request)
+
+    @override_settings(HEALTH_NPLUSONE_DETECTION=True)
+    async def test_async_chain_is_recorded(self):
+        """Test that the detector runs natively in an async chain and still sees the view's queries"""
+        async def get_response(request):
+            return await sync_to_async(_per_row_view)(request)
+        middleware = NPlusOneMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+
+        with self.assertLogs('health.middleware', 'WARNING') as logs:
+            await middleware(AsyncRequestFactory().get('/api/patients/'))
+        self.assertIn('5 x SELECT', logs.output[0])
+
+
+TIERED_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'tiered': {
+        'BACKEND': 'health.cache.TieredCache',
+        'OPTIONS': {'L1': 'tier-local', 'L2': 'tier-shared', 'L1_TIMEOUT': 5},
+    },
+    'tier-local': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tier-local'},
+    'tier-shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tier-shared'},
+}
+
+
+@override_settings(CACHES=TIERED_CACHES)
+class TieredCacheTests(TestCase):
+    """Test the local L1 tier in front of the shared cache"""
+
+    def setUp(self):
+        self.cache, self.l1, self.l2 = caches['tiered'], caches['tier-local'], caches['tier-shared']
+        self.cache.clear()
+
+    def test_reads_fill_l1(self):
+        """Test that a shared hit is kept locally and writes reach both tiers"""
+        self.l2.set('key', 'shared')
+        self.assertEqual(self.cache.get('key'), 'shared')
+        self.assertEqual(self.l1.get('key'), 'shared')
+
+        self.cache.set('key', 'new')
+        self.assertEqual((self.l1.get('key'), self.l2.get('key')), ('new', 'new'))
+        self.cache.delete('key')
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_unloadable_backends_fail_checks(self):
+        """Test that a missing Redis client or tier alias is reported before any request"""
+        caches_setting = dict(TIERED_CACHES, shared={'BACKEND': 'django.core.cache.backends.redis.RedisCache'})
+        caches_setting['tiered'] = {'BACKEND': 'health.cache.TieredCache', 'OPTIONS': {'L1': 'tier-local', 'L2': 'nope'}}
+        with self.settings(CACHES=caches_setting), mock.patch.dict('sys.modules', {'redis': None}):
+            self.assertEqual([error.id for error in check_cache_backends(None)], ['health.E003', 'health.E002'])
+            with self.assertRaises(ImproperlyConfigured):
+                check_caches()
+        self.assertEqual(check_cache_backends(None), [])
+
+    def test_atomic_operations_use_shared_tier(self):
+        """Test that add and incr are decided by the shared tier"""
+        self.l2.set('lock', 1)
+        self.assertFalse(self.cache.add('lock', 2))
+        self.l1.set('counter', 100)
+        self.l2.set('counter', 1)
+        self.assertEqual(self.cache.incr('counter'), 2)
+        self.assertEqual(self.cache.get('counter'), 2)
+
+
+PRODUCTION_MIDDLEWARE = [
+    {
+        'django.contrib.sessions.middleware.SessionMiddleware': 'health.middleware.SiteSessionMiddleware',
+        'django.middleware.csrf.CsrfViewMiddleware': 'health.middleware.SiteCsrfViewMiddleware',
+        'django.contrib.auth.middleware.AuthenticationMiddleware': 'health.middleware.SiteAuthenticationMiddleware',
+        'django.contrib.messages.middleware.MessageMiddleware': 'health.middleware.SiteMessageMiddleware',
+    }.get(name, name)
+    for name in settings.MIDDLEWARE
+]
+
+
+@override_settings(MIDDLEWARE=PRODUCTION_MIDDLEWARE)
+class StatelessAPITests(APITestCase):
+    """Test that API requests skip the session-era middleware"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='securepassword123')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_api_request_is_stateless(self):
+        """Test that API responses neither read nor set session or CSRF cookies"""
+        response = self.client.post(reverse('patient-list'), {
+            'name': 'John Doe', 'age': 45, 'gender': 'Male'
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertFalse(hasattr(response.wsgi_request, 'session'))
+        self.assertNotIn('Cookie', response.get('Vary', ''))
+        self.assertEqual(response.cookies, {})
+
+    @skipIf(not settings.ENABLE_ADMIN, "Admin not installed")
+    def test_admin_keeps_session_and_csrf(self):
+        """Test that site pages still get sessions and CSRF protection"""
+        response = self.client.get(reverse('admin:login'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('csrftoken', response.cookies)
+
+    def test_scaling_efficiency(self):
+        """Test the benchmark's efficiency figure against the single-worker rate"""
+        self.assertEqual(efficiency({1: 100.0, 2: 180.0, 4: 400.0}), {1: 1.0, 2: 0.9, 4: 1.0})
@@ -0,0 +1,240 @@
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.http import JsonResponse
+from django.urls import URLPattern, URLResolver
+from rest_framework.throttling import BaseThrottle
+
+PERIODS = {'s': 1, 'sec': 1, 'm': 60, 'min': 60, 'h': 3600, 'hour': 3600, 'd': 86400, 'day': 86400}
+
+
+def parse_rate(rate):
+    # "10/min" -> (10 tokens, refilled at 10 per 60 seconds)
+    num, period = rate.split('/')
+    return int(num), PERIODS[period]
+
+
+class TokenBucketStore:
+    """
+    Rate buckets kept in the shared cache so every worker sees the same
+    counts. Each bucket is approximated by two fixed-window counters (the
+    previous window weighted by how much of it still overlaps the last
+    `period` seconds), so every update is an atomic cache add/incr rather
+    than a read-modify-write that concurrent workers could overwrite. If the
+    cache backend is unavailable we fall back to a bounded process-local
+    cache rather than failing open or closed.
+    """
+
+    def __init__(self, alias=None):
+        self.alias = alias or getattr(settings, 'HEALTH_THROTTLE_CACHE', 'default')
+        self._local = LocMemCache('health-throttle-fallback', {'OPTIONS': {'MAX_ENTRIES': 10000}})
+
+    def _call(self, method, *args):
+        try:
+            return getattr(self, method)(caches[self.alias], *args)
+        except Exception:
+            return getattr(self, method)(self._local, *args)
+
+    @staticmethod
+    def _incr(cache, key, timeout):
+        for _ in range(2):
+            cache.add(key, 0, timeout)
+            try:
+                return cache.incr(key)
+            except ValueError:
+                pass  # expired between add() and incr()
+        raise ValueError(key)
+
+    @staticmethod
+    def _decr(cache, key):
+        try:
+            cache.decr(key)
+        except ValueError:
+            pass
+
+    @staticmethod
+    def _get(cache, key):
+        return cache.get(key) or 0
+
+    def consume(self, key, capacity, period):
+        """
+        Take one token from the bucket. Returns 0 if the request is allowed,
+        otherwise the number of seconds until a token becomes available.
+        """
+        return self.consume_all([(key, capacity, period)])
+
+    def consume_all(self, buckets):
+        """
+        Take one token from each (key, capacity, period) bucket, or from none
+        of them: if any bucket refuses, the others are refunded. Returns 0 or
+        the longest wait among the refusing buckets.
+        """
+        # Wall clock, since buckets are shared between processes
+        now = time.time()
+        charged, wait = [], 0
+        for key, capacity, period in buckets:
+            window = int(now // period)
+            elapsed = now / period - window
+            current_key = f"{key}:{window}"
+            current = self._call('_incr', current_key, int(2 * period) + 1)
+            charged.append(current_key)
+            previous = self._call('_get', f"{key}:{window - 1}")
+            if previous * (1 - elapsed) + current > capacity:
+                wait = max(wait, self._wait(capacity, period, current, previous, elapsed))
+        if wait:
+            # Refused requests do not count against the caller
+            for current_key in charged:
+                self._call('_decr', current_key)
+        return wait
+
+    @staticmethod
+    def _wait(capacity, period, current, previous, elapsed):
+        if current <= capacity:
+            # The previous window's share decays enough later in this one
+            return ((1 - (capacity - current) / previous) - elapsed) * period
+        # Wait for this window to become the previous one and decay in turn
+        used = current - 1
+        return ((1 - elapsed) + max(0.0, 1 - (capacity - 1) / used)) * period
+
+
+def rate_buckets(key, rate, burst=None):
+    """
+    The (key, capacity, period) buckets enforcing `rate` ("20/hour"). With a
+    smaller `burst`, a second bucket holds bursts to that many requests per
+    burst / rate of the period (5 per 15 minutes for 20/hour), so the full
+    rate is reached by spreading requests out rather than all at once.
+    """
+    count, period = parse_rate(rate)
+    buckets = [(key, count, period)]
+    if burst and burst < count:
+        buckets.append((f"{key}:burst", burst, period * burst / count))
+    return buckets
+
+
+bucket_store = TokenBucketStore()
+
+
+class EndpointTokenBucketThrottle(BaseThrottle):
+    """
+    Token-bucket throttle driven by the per-endpoint policy attached to the
+    request by `limit_endpoint`. The `ip` rate applies to every caller, the
+    `user` rate additionally applies to authenticated users.
+    """
+
+    def allow_request(self, request, view):
+        self._wait = 0
+        policy = getattr(request, 'endpoint_limits', None)
+        if not policy:
+            return True
+
+        name = policy['name']
+        checks = []
+        if policy.get('ip'):
+            checks.append((f"throttle:{name}:ip:{self.get_ident(request)}", policy['ip']))
+        user = getattr(request, 'user', None)
+        if policy.get('user') and user is not None and user.is_authenticated:
+            checks.append((f"throttle:{name}:user:{user.pk}", policy['user']))
+
+        buckets = [bucket for key, rate in checks for bucket in rate_buckets(key, rate, policy.get('burst'))]
+        if buckets:
+            self._wait = bucket_store.consume_all(buckets)
+        return self._wait == 0
+
+    def wait(self):
+        return self._wait
+
+
+class ConcurrencyLimiter:
+    """
+    Caps in-flight requests for one endpoint in this worker. Up to
+    `max_queue` extra requests may wait `queue_timeout` seconds for a slot;
+    beyond that depth they are shed immediately.
+    """
+
+    def __init__(self, max_concurrent, max_queue=0, queue_timeout=0.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            if self.active < self.max_concurrent:
+                self.active += 1
+                return True
+            if self.waiting >= self.max_queue:
+                return False
+            self.waiting += 1
+            try:
+                deadline = time.monotonic() + self.queue_timeout
+                while self.active >= self.max_concurrent:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+
+def limit_endpoint(view, name, policy):
+    """
+    Wrap a URL callback so the request carries its throttling policy and is
+    shed with 503 + Retry-After once the endpoint's concurrency limit and
+    queue are full.
+    """
+    policy = dict(policy, name=name)
+    limiter = None
+    if policy.get('max_concurrent'):
+        limiter = ConcurrencyLimiter(
+            policy['max_concurrent'],
+            policy.get('max_queue', 0),
+            policy.get('queue_timeout', 0.0),
+        )
+
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        request.endpoint_limits = policy
+        if limiter is None:
+            return view(request, *args, **kwargs)
+        if not limiter.acquire():
+            response = JsonResponse(
+                {"error": "Server is busy, please retry shortly"},
+                status=503,
+            )
+            response['Retry-After'] = str(policy.get('retry_after', 1))
+            return response
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            limiter.release()
+
+    wrapped.limiter = limiter
+    return wrapped
+
+
+def apply_endpoint_limits(patterns, limits, _wrapped=None):
+    # Walk the URL tree and wrap every named pattern that has a policy.
+    # Format-suffix variants share a callback, so they share one limiter too.
+    _wrapped = {} if _wrapped is None else _wrapped
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            apply_endpoint_limits(pattern.url_patterns, limits, _wrapped)
+        elif isinstance(pattern, URLPattern) and pattern.name in limits:
+            key = (pattern.name, id(pattern.callback))
+            if key not in _wrapped:
+                _wrapped[key] = limit_endpoint(pattern.callback, pattern.name, limits[pattern.name])
+            pattern.callback = _wrapped[key]
+    return patterns
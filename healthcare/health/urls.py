@@ -7,29 +7,64 @@ from .views import (
     PatientViewSet,
     DoctorViewSet,
     PatientDoctorMappingViewSet,
-    get_doctors_for_patient
+    JobViewSet,
+    get_doctors_for_patient,
+    logout
 )
+from .batch import batch
+from .stream import changes, stream_ticket
+from .throttling import apply_endpoint_limits
 
 # Create a router for our ViewSets
 router = DefaultRouter()
 router.register(r'patients', PatientViewSet, basename='patient')
 router.register(r'doctors', DoctorViewSet, basename='doctor')
 router.register(r'mappings', PatientDoctorMappingViewSet, basename='mapping')
+router.register(r'jobs', JobViewSet, basename='job')
 
 # Authentication endpoints
 auth_urls = [
     path('register/', RegisterView.as_view({'post': 'create'}), name='register'),
     path('login/', CustomTokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('token/refresh/', CustomTokenRefreshView.as_view(), name='token_refresh'),
+    path('logout/', logout, name='logout'),
 ]
 
+# Throttling and load shedding per endpoint name:
+#   ip / user       token-bucket rate per client IP / per authenticated user
+#   burst           requests allowed back to back; the rest of the rate must
+#                   be spread out (defaults to the rate's request count)
+#   max_concurrent  in-flight requests per worker before shedding with 503
+#   max_queue       extra requests allowed to wait up to queue_timeout seconds
+ENDPOINT_LIMITS = {
+    'register': {'ip': '20/hour', 'burst': 5, 'max_concurrent': 4, 'max_queue': 4, 'queue_timeout': 2},
+    'token_obtain_pair': {'ip': '30/min', 'burst': 10, 'max_concurrent': 8, 'max_queue': 8, 'queue_timeout': 2},
+    'token_refresh': {'ip': '60/min'},
+    'patient-list': {'user': '600/min'},
+    'doctor-list': {'user': '600/min'},
+    'mapping-list': {'user': '600/min'},
+    'get_doctors_for_patient': {'user': '600/min'},
+    'job-list': {'user': '30/min'},
+    'stream-ticket': {'user': '60/min'},
+}
+
 urlpatterns = [
     # Include auth URLs
     path('auth/', include(auth_urls)),
-    
+
+    # Several API calls in one round trip
+    path('batch/', batch, name='batch'),
+
+    # Server-sent events for the user's patients and mappings (ASGI only).
+    # Not in ENDPOINT_LIMITS: limit_endpoint wraps sync views only.
+    path('stream/', changes, name='stream'),
+    path('stream/ticket/', stream_ticket, name='stream-ticket'),
+
     # Special endpoint for getting all doctors for a specific patient
     path('mappings/<int:patient_id>/', get_doctors_for_patient, name='get_doctors_for_patient'),
-    
+
     # Include router URLs
     path('', include(router.urls)),
-]
\ No newline at end of file
+]
+
+apply_endpoint_limits(urlpatterns, ENDPOINT_LIMITS)
@@ -1,17 +1,52 @@
-from rest_framework import viewsets, permissions, status
+from rest_framework import viewsets, permissions, status, mixins
 from rest_framework.response import Response
+from rest_framework.exceptions import ValidationError
 from django.contrib.auth.models import User
-from .models import Patient, Doctor, PatientDoctorMapping
+from .models import Patient, Doctor, PatientDoctorMapping, Job
 from .serializers import (
     RegisterSerializer, 
     PatientSerializer, 
     DoctorSerializer, 
-    PatientDoctorMappingSerializer
+    PatientDoctorMappingSerializer,
+    PatientDoctorMappingCreateSerializer,
+    JobSerializer,
+    JobListSerializer,
+    LogoutSerializer,
+    RevocableTokenRefreshSerializer,
+    requested_fields,
+    requested_expansions
 )
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.decorators import api_view, permission_classes
 from django.shortcuts import get_object_or_404
+from django.db.models import Prefetch
+from .idempotency import idempotent
+from .revocation import revoke
+
+
+def sparse_queryset(queryset, serializer_class, request):
+    # Narrow the SELECT to the columns behind the fields requested in ?fields=
+    fields = requested_fields(request)
+    if not fields:
+        return queryset
+    # With the request, so fields that only exist under ?expand= are known
+    serializer_fields = serializer_class(context={'request': request}).fields
+    unknown = fields - set(serializer_fields)
+    if unknown:
+        raise ValidationError({"fields": [f"Unknown field: {name}" for name in sorted(unknown)]})
+    columns = {f.name for f in queryset.model._meta.concrete_fields}
+    sources = {serializer_fields[name].source for name in fields}
+    return queryset.only(queryset.model._meta.pk.name, *(sources & columns))
+
+
+class SparseFieldsetViewMixin:
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        return sparse_queryset(queryset, self.get_serializer_class(), self.request)
 
 
 # Authentication Views
@@ -20,6 +55,29 @@ class CustomTokenObtainPairView(TokenObtainPairView):
 
 class CustomTokenRefreshView(TokenRefreshView):
     permission_classes = [AllowAny]
+    serializer_class = RevocableTokenRefreshSerializer
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def logout(request):
+    # Revoke the access token used for this request and, if given, a refresh token
+    serializer = LogoutSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+
+    # No access token when authenticated by a batch request's forced user
+    tokens = [request.auth] if request.auth is not None else []
+    if 'refresh' in serializer.validated_data:
+        try:
+            refresh = RefreshToken(serializer.validated_data['refresh'])
+        except TokenError as exc:
+            return Response({"refresh": [str(exc)]}, status=status.HTTP_400_BAD_REQUEST)
+        if str(refresh.get(jwt_settings.USER_ID_CLAIM)) != str(request.user.pk):
+            return Response({"refresh": ["Token belongs to another user"]}, status=status.HTTP_400_BAD_REQUEST)
+        tokens.append(refresh)
+
+    for token in tokens:
+        revoke(token)
+    return Response(status=status.HTTP_204_NO_CONTENT)
 
 class RegisterView(viewsets.ModelViewSet):
     queryset = User.objects.all()
@@ -38,13 +96,34 @@ class RegisterView(viewsets.ModelViewSet):
 
 
 # Patient Views
-class PatientViewSet(viewsets.ModelViewSet):
+class PatientViewSet(SparseFieldsetViewMixin, viewsets.ModelViewSet):
     serializer_class = PatientSerializer
     permission_classes = [IsAuthenticated]
 
+    expandable = {'doctors'}
+
     def get_queryset(self):
         # Only return patients created by the current user
-        return Patient.objects.filter(created_by=self.request.user)
+        queryset = Patient.objects.filter(created_by=self.request.user)
+
+        expand = requested_expansions(self.request)
+        unknown = expand - self.expandable
+        if unknown:
+            raise ValidationError({"expand": [f"Cannot expand: {name}" for name in sorted(unknown)]})
+        fields = requested_fields(self.request)
+        if 'doctors' in expand and (not fields or 'doctors' in fields):
+            # One extra query for the whole page: mappings joined to doctors,
+            # kept to the user's own partition
+            queryset = queryset.prefetch_related(Prefetch(
+                'patientdoctormapping_set',
+                queryset=PatientDoctorMapping.objects.filter(owner=self.request.user)
+                .select_related('doctor').order_by('id')
+            ))
+        return queryset
+
+    @idempotent
+    def create(self, request, *args, **kwargs):
+        return super().create(request, *args, **kwargs)
     
     def perform_create(self, serializer):
         # Set the created_by field to the current user
@@ -52,7 +131,7 @@ class PatientViewSet(viewsets.ModelViewSet):
 
 
 # Doctor Views
-class DoctorViewSet(viewsets.ModelViewSet):
+class DoctorViewSet(SparseFieldsetViewMixin, viewsets.ModelViewSet):
     queryset = Doctor.objects.all()
     serializer_class = DoctorSerializer
     permission_classes = [IsAuthenticated]
@@ -64,30 +143,69 @@ class PatientDoctorMappingViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        return PatientDoctorMapping.objects.all()
+        # Only mappings of the current user's patients
+        return PatientDoctorMapping.objects.filter(owner=self.request.user)
     
+    @idempotent
     def create(self, request, *args, **kwargs):
-        # Get patient_id and doctor_id from request data
-        patient_id = request.data.get('patient')
-        doctor_id = request.data.get('doctor')
-        
-        # Check if patient belongs to the current user
-        try:
-            patient = Patient.objects.get(id=patient_id, created_by=request.user)
-        except Patient.DoesNotExist:
+        # Only parse the ids here; ownership, doctor existence and uniqueness
+        # are all checked by the single INSERT in create_for_owner
+        serializer = PatientDoctorMappingCreateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        result, mapping = PatientDoctorMapping.objects.create_for_owner(
+            serializer.validated_data['patient'],
+            serializer.validated_data['doctor'],
+            request.user
+        )
+
+        if result == PatientDoctorMapping.objects.PATIENT_NOT_FOUND:
             return Response(
                 {"error": "Patient not found or you don't have permission to assign doctors to this patient"}, 
                 status=status.HTTP_404_NOT_FOUND
             )
-        
-        # Check if mapping already exists
-        if PatientDoctorMapping.objects.filter(patient=patient_id, doctor=doctor_id).exists():
+        if result == PatientDoctorMapping.objects.DOCTOR_NOT_FOUND:
+            return Response(
+                {"doctor": ["Doctor not found"]},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if result == PatientDoctorMapping.objects.DUPLICATE:
             return Response(
                 {"error": "This doctor is already assigned to this patient"}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
-            
-        return super().create(request, *args, **kwargs)
+
+        return Response(self.get_serializer(mapping).data, status=status.HTTP_201_CREATED)
+
+
+# Background Job Views
+class JobViewSet(mixins.CreateModelMixin,
+                 mixins.RetrieveModelMixin,
+                 mixins.ListModelMixin,
+                 viewsets.GenericViewSet):
+    serializer_class = JobSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        # Users only see the jobs they started
+        queryset = Job.objects.filter(created_by=self.request.user).order_by('-id')
+        if self.action == 'list':
+            queryset = queryset.defer('result')
+        return queryset
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return JobListSerializer
+        return JobSerializer
+
+    def create(self, request, *args, **kwargs):
+        # Jobs run in the run_jobs worker; poll GET /api/jobs/<id>/ for progress
+        response = super().create(request, *args, **kwargs)
+        response.status_code = status.HTTP_202_ACCEPTED
+        return response
+
+    def perform_create(self, serializer):
+        serializer.save(created_by=self.request.user)
 
 
 # Get all doctors for a specific patient
@@ -103,10 +221,14 @@ def get_doctors_for_patient(request, patient_id):
             status=status.HTTP_404_NOT_FOUND
         )
     
-    # Get all mappings for this patient
-    mappings = PatientDoctorMapping.objects.filter(patient=patient_id)
-    doctors = [mapping.doctor for mapping in mappings]
+    # Get the doctors of all live mappings for this patient in one query
+    doctors = Doctor.objects.filter(
+        patientdoctormapping__owner=request.user,
+        patientdoctormapping__patient=patient_id,
+        patientdoctormapping__deleted_at__isnull=True
+    ).order_by('patientdoctormapping__id')
+    doctors = sparse_queryset(doctors, DoctorSerializer, request)
     
     # Serialize the doctors and return
-    serializer = DoctorSerializer(doctors, many=True)
+    serializer = DoctorSerializer(doctors, many=True, context={'request': request})
     return Response(serializer.data)
\ No newline at end of file
@@ -8,9 +8,19 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
 
 import os
+import time
+
+booted_at = time.perf_counter()
 
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'healthcare.settings')
 
 application = get_asgi_application()
+
+# Fail on a missing cache client now, then finish lazy setup instead of
+# on the first request (HEALTH_PREWARM)
+from health.startup import check_caches, prewarm_if_enabled  # noqa: E402
+
+check_caches()
+prewarm_if_enabled(booted_at)
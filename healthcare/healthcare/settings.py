@@ -17,10 +17,16 @@ DEBUG = os.environ.get('DEBUG', 'True') == 'True'
 
 ALLOWED_HOSTS = os.environ.get('ALLOWED_HOSTS', 'localhost,127.0.0.1').split(',')
 
+# 'production' selects the stateless multi-node profile at the end of this file
+HEALTH_PROFILE = os.environ.get('HEALTH_PROFILE', 'development')
+
+# API-only workers can skip importing and routing the admin
+ENABLE_ADMIN = os.environ.get('ENABLE_ADMIN', 'True') == 'True'
+
 
 # Application definition
 INSTALLED_APPS = [
-    'django.contrib.admin',
+    *(['django.contrib.admin'] if ENABLE_ADMIN else []),
     'django.contrib.auth',
     'django.contrib.contenttypes',
     'django.contrib.sessions',
@@ -38,6 +44,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # Before anything that reads or changes the response body
+    'health.middleware.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -45,6 +53,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Only installed when HEALTH_NPLUSONE_DETECTION is on
+    'health.middleware.NPlusOneMiddleware',
 ]
 
 ROOT_URLCONF = 'healthcare.urls'  # Replace with your project name
@@ -124,7 +134,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'health.authentication.RevocableJWTAuthentication',
     ),
     # We'll explicitly set permissions on view level rather than globally
     'DEFAULT_PERMISSION_CLASSES': [
@@ -132,8 +142,77 @@ REST_FRAMEWORK = {
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10,
+    # Rates are set per endpoint in health/urls.py (ENDPOINT_LIMITS)
+    'DEFAULT_THROTTLE_CLASSES': [
+        'health.throttling.EndpointTokenBucketThrottle',
+    ],
+    # Reverse proxies in front of the app. Per-IP throttling trusts only
+    # that many X-Forwarded-For entries; with 0 it uses REMOTE_ADDR, so
+    # clients cannot pick their own bucket by sending the header.
+    'NUM_PROXIES': int(os.environ.get('HEALTH_NUM_PROXIES', 0)),
 }
 
+# Cache alias holding the shared throttle token buckets
+HEALTH_THROTTLE_CACHE = os.environ.get('HEALTH_THROTTLE_CACHE', 'default')
+
+# Idempotency-Key support on POST /api/patients/ and /api/mappings/
+HEALTH_IDEMPOTENCY_CACHE = os.environ.get('HEALTH_IDEMPOTENCY_CACHE', 'default')
+HEALTH_IDEMPOTENCY_TTL = int(os.environ.get('HEALTH_IDEMPOTENCY_TTL', 24 * 60 * 60))
+HEALTH_IDEMPOTENCY_LOCK_TIMEOUT = 30  # seconds a first request may hold the key
+HEALTH_IDEMPOTENCY_WAIT = 5  # seconds a concurrent duplicate waits for the result
+
+# Responses smaller than this are sent uncompressed; brotli is used when the
+# optional `brotli` package is installed and the client accepts it
+HEALTH_COMPRESSION_MIN_SIZE = int(os.environ.get('HEALTH_COMPRESSION_MIN_SIZE', 1024))
+HEALTH_BROTLI_QUALITY = 5
+
+# POST /api/batch/: maximum sub-requests, and whether runs of reads execute
+# concurrently under ASGI (each thread on its own DB connection)
+HEALTH_BATCH_MAX_REQUESTS = 20
+HEALTH_BATCH_CONCURRENT_READS = os.environ.get('HEALTH_BATCH_CONCURRENT_READS', 'True') == 'True'
+HEALTH_BATCH_MAX_THREADS = int(os.environ.get('HEALTH_BATCH_MAX_THREADS', 4))
+
+# GET /api/stream/ change events: 'local' reaches streams in this process only,
+# 'postgres' fans out to every worker through LISTEN/NOTIFY
+HEALTH_EVENTS_BACKEND = os.environ.get('HEALTH_EVENTS_BACKEND', 'local')
+HEALTH_EVENTS_KEEPALIVE = 15  # seconds between keep-alive comments
+HEALTH_EVENTS_MAX_AGE = 300  # seconds before a stream closes and the client reconnects
+HEALTH_EVENTS_QUEUE_SIZE = 100  # undelivered events per stream before it is told to resync
+HEALTH_EVENTS_MAX_STREAMS_PER_USER = 5  # open streams per user in one worker; more get a 429
+HEALTH_STREAM_TICKET_CACHE = os.environ.get('HEALTH_STREAM_TICKET_CACHE', 'default')
+HEALTH_STREAM_TICKET_TTL = 30  # seconds a stream ticket stays valid
+
+# Admin changelists switch to PostgreSQL row estimates above this many rows
+HEALTH_ADMIN_EXACT_COUNT_LIMIT = int(os.environ.get('HEALTH_ADMIN_EXACT_COUNT_LIMIT', 100000))
+
+# run_jobs workers renew a running job's lease while it runs; a job whose
+# worker died is claimed again once the lease lapses, up to MAX_ATTEMPTS
+HEALTH_JOB_LEASE = int(os.environ.get('HEALTH_JOB_LEASE', 300))
+HEALTH_JOB_MAX_ATTEMPTS = int(os.environ.get('HEALTH_JOB_MAX_ATTEMPTS', 3))
+
+# Warm URL resolvers, serializers and the DB connection when a WSGI/ASGI
+# worker boots rather than on its first request (on by default in production)
+HEALTH_PREWARM = os.environ.get('HEALTH_PREWARM', str(not DEBUG)) == 'True'
+# Worker boot-to-ready budget; exceeding it is logged and fails profile_startup
+HEALTH_STARTUP_TARGET_SECONDS = float(os.environ.get('HEALTH_STARTUP_TARGET_SECONDS', 1.5))
+
+# Hash partitions per tenant table created by migration 0005 on PostgreSQL;
+# grow later with `manage.py tenant_partitions split`
+HEALTH_TENANT_PARTITIONS = int(os.environ.get('HEALTH_TENANT_PARTITIONS', 8))
+
+# Log the call site when one request repeats a SQL statement this many times
+# (development aid, on by default with DEBUG)
+HEALTH_NPLUSONE_DETECTION = os.environ.get('HEALTH_NPLUSONE_DETECTION', str(DEBUG)) == 'True'
+HEALTH_NPLUSONE_THRESHOLD = 5
+
+# Token revocation (POST /api/auth/logout/). Each worker screens JTIs with an
+# in-memory bloom filter and only queries RevokedToken on a probable hit.
+HEALTH_REVOCATION_REFRESH = 5  # seconds before revocations by other workers are seen
+HEALTH_REVOCATION_OVERLAP = 60  # seconds a revocation may take to commit and still be seen
+HEALTH_REVOCATION_REBUILD = 300  # seconds between full rebuilds, dropping expired tokens
+HEALTH_REVOCATION_CAPACITY = 10000  # smallest filter size, in tokens
+HEALTH_REVOCATION_ERROR_RATE = 0.001  # share of live tokens that need a DB check
+
 # JWT settings
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),
@@ -184,4 +263,68 @@ LOGGING = {
 
 # CORS settings - adjust as needed for production
 CORS_ALLOW_ALL_ORIGINS = DEBUG  # Only allow all origins in debug mode
-CORS_ALLOWED_ORIGINS = os.environ.get('CORS_ALLOWED_ORIGINS', 'http://localhost:3000').split(',')
\ No newline at end of file
+CORS_ALLOWED_ORIGINS = os.environ.get('CORS_ALLOWED_ORIGINS', 'http://localhost:3000').split(',')
+
+# Stateless multi-node profile: nothing a request needs lives on one node
+if HEALTH_PROFILE == 'production':
+    # JWT API requests under HEALTH_API_PREFIX skip sessions, CSRF, Django's
+    # auth middleware and messages; the admin keeps them
+    HEALTH_API_PREFIX = '/api/'
+    MIDDLEWARE = [
+        'django.middleware.security.SecurityMiddleware',
+        'health.middleware.CompressionMiddleware',
+        'health.middleware.SiteSessionMiddleware',
+        'corsheaders.middleware.CorsMiddleware',
+        'django.middleware.common.CommonMiddleware',
+        'health.middleware.SiteCsrfViewMiddleware',
+        'health.middleware.SiteAuthenticationMiddleware',
+        'health.middleware.SiteMessageMiddleware',
+        'django.middleware.clickjacking.XFrameOptionsMiddleware',
+        'health.middleware.NPlusOneMiddleware',
+    ]
+    # Admin sessions are signed cookies, so no node or table holds them
+    SESSION_ENGINE = 'django.contrib.sessions.backends.signed_cookies'
+
+    # Shared cache (Redis, client in requirements.txt) with a per-process L1 in front.
+    # Throttle buckets and idempotency locks must agree across nodes, so
+    # they use the shared tier directly.
+    CACHES = {
+        'default': {
+            'BACKEND': 'health.cache.TieredCache',
+            'OPTIONS': {'L1': 'local', 'L2': 'shared', 'L1_TIMEOUT': 5},
+        },
+        'shared': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('HEALTH_CACHE_URL', 'redis://127.0.0.1:6379/0'),
+        },
+        'local': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        },
+    }
+    HEALTH_THROTTLE_CACHE = os.environ.get('HEALTH_THROTTLE_CACHE', 'shared')
+    HEALTH_IDEMPOTENCY_CACHE = os.environ.get('HEALTH_IDEMPOTENCY_CACHE', 'shared')
+    # Tickets are issued on one node and redeemed on another, exactly once
+    HEALTH_STREAM_TICKET_CACHE = os.environ.get('HEALTH_STREAM_TICKET_CACHE', 'shared')
+
+    # Change events must reach streams on every node
+    HEALTH_EVENTS_BACKEND = os.environ.get('HEALTH_EVENTS_BACKEND', 'postgres')
+
+    # Log to stderr for the platform to collect instead of a node-local file
+    LOGGING = {
+        'version': 1,
+        'disable_existing_loggers': False,
+        'formatters': {
+            'process': {'format': '%(asctime)s %(levelname)s %(name)s [%(process)d] %(message)s'},
+        },
+        'handlers': {
+            'console': {
+                'class': 'logging.StreamHandler',
+                'formatter': 'process',
+            },
+        },
+        'root': {
+            'handlers': ['console'],
+            'level': os.environ.get('LOG_LEVEL', 'INFO'),
+        },
+    }
@@ -14,10 +14,13 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
-from django.contrib import admin
+from django.conf import settings
 from django.urls import path, include
 
 urlpatterns = [
-    path('admin/', admin.site.urls),
     path('api/', include('health.urls')),  # Replace 'healthcare_app' with your app name
-]
\ No newline at end of file
+]
+
+if settings.ENABLE_ADMIN:
+    from django.contrib import admin
+    urlpatterns.insert(0, path('admin/', admin.site.urls))
\ No newline at end of file